@@ -0,0 +1,783 @@
+"""
+small benchmarks and numerical parity checks for the fast paths in makemore.py.
+each subcommand builds models from ModelConfig on random weights, checks that the
+fast path agrees with the reference implementation, and then times both. e.g.:
+
+$ python bench.py kvcache
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import torch
+from torch.nn import functional as F
+
+from makemore import ModelConfig, Transformer, RNN, BoW, CausalBoW, MLP, Bigram, AliasSampler, generate, generate_until_stop, sample_next
+from makemore import create_model, evaluate, quantize, export_model, ExportedModel, read_words, save_meta
+from makemore import PhaseTimer, autocast
+from makemore import create_datasets, CharDataset, InfiniteDataLoader, InMemoryBatchLoader, BucketedBatchLoader, padding_ratio
+
+# -----------------------------------------------------------------------------
+
+def timeit(fn, warmup=2, repeat=5):
+    """ returns the best wall time of fn() in seconds over a few repeats """
+    for _ in range(warmup):
+        fn()
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.time()
+        fn()
+        best = min(best, time.time() - t0)
+    return best
+
+# -----------------------------------------------------------------------------
+
+def compare_sampling(model, args, steps):
+    """ checks that cached sampling reproduces uncached sampling exactly, then times both """
+    X_init = torch.zeros(args.num_samples, 1, dtype=torch.long)
+    torch.manual_seed(args.seed)
+    samples_uncached = generate(model, X_init, steps, do_sample=True, use_cache=False)
+    torch.manual_seed(args.seed)
+    samples_cached = generate(model, X_init, steps, do_sample=True, use_cache=True)
+    assert torch.equal(samples_uncached, samples_cached), "cached samples differ from uncached samples"
+    print(f"sampled {args.num_samples} identical sequences with and without the cache")
+
+    for use_cache in [False, True]:
+        dt = timeit(lambda: generate(model, X_init, steps, do_sample=True, use_cache=use_cache))
+        print(f"use_cache={use_cache}: {dt*1000:.2f}ms, {args.num_samples/dt:.0f} samples/s")
+
+def bench_kvcache(args):
+    """ KV-cache incremental decoding vs. re-running the full prefix every step """
+    config = ModelConfig(vocab_size=27, block_size=args.block_size, n_layer=4, n_head=4, n_embd=64)
+    torch.manual_seed(args.seed)
+    model = Transformer(config)
+    model.eval()
+
+    # parity: the logits at every position must match with and without the cache
+    idx = torch.randint(1, config.vocab_size, (8, args.block_size))
+    with torch.no_grad():
+        logits_full, _ = model(idx)
+        kv_cache = model.init_kv_cache()
+        logits_inc = torch.cat([model(idx[:, t:t+1], kv_cache=kv_cache)[0] for t in range(idx.size(1))], dim=1)
+    max_diff = (logits_full - logits_inc).abs().max().item()
+    print(f"max abs logit difference, cached vs uncached: {max_diff:.2e}")
+    assert torch.allclose(logits_full, logits_inc, atol=1e-5), "KV-cache logits diverge from the full forward"
+
+    # parity: for a fixed seed the sampled names must be identical
+    compare_sampling(model, args, args.block_size - 1)
+
+def bench_rnnstep(args):
+    """ stateful RNN/GRU sampling vs. re-running the recurrence over the prefix every step """
+    config = ModelConfig(vocab_size=27, block_size=args.block_size, n_embd=64, n_embd2=64)
+    for cell_type in ['rnn', 'gru']:
+        print(f"--- {cell_type}")
+        torch.manual_seed(args.seed)
+        model = RNN(config, cell_type=cell_type)
+        model.eval()
+
+        # parity: stepping token by token must give the logits of the full forward
+        idx = torch.randint(1, config.vocab_size, (8, args.block_size))
+        with torch.no_grad():
+            logits_full, _ = model(idx)
+            hidden, logits_inc = None, []
+            for t in range(idx.size(1)):
+                logits, hidden = model.step(idx[:, t], hidden)
+                logits_inc.append(logits)
+            logits_inc = torch.stack(logits_inc, 1)
+        max_diff = (logits_full - logits_inc).abs().max().item()
+        print(f"max abs logit difference, step vs forward: {max_diff:.2e}")
+        assert torch.allclose(logits_full, logits_inc, atol=1e-5), "RNN.step logits diverge from the full forward"
+
+        compare_sampling(model, args, args.block_size - 1)
+
+def bench_earlystop(args):
+    """ generation that retires rows at <STOP> vs. always running the full block length """
+    config = ModelConfig(vocab_size=27, block_size=args.block_size, n_layer=4, n_head=4, n_embd=64, n_embd2=64)
+    X_init = torch.zeros(args.num_samples, 1, dtype=torch.long)
+    steps = args.block_size - 1
+    for name, model_fn in [('transformer', Transformer), ('gru', lambda c: RNN(c, 'gru')), ('bow', BoW)]:
+        print(f"--- {name}")
+        torch.manual_seed(args.seed)
+        model = model_fn(config)
+        # random weights sample ~uniformly, so raise the <STOP> logit to get name-like lengths
+        def add_stop_bias(module, inputs, logits):
+            logits[..., 0] += args.stop_bias
+        model.lm_head.register_forward_hook(add_stop_bias)
+        model.eval()
+
+        # parity: greedy decoding cropped at the first <STOP> must match the ragged output
+        full = generate(model, X_init[:64], steps)
+        ragged = generate_until_stop(model, X_init[:64], steps)
+        for row, seq in zip(full.tolist(), ragged):
+            row = row[:row.index(0, 1)] if 0 in row[1:] else row
+            assert row == seq.tolist(), "early-stopped generation differs from the cropped full generation"
+
+        lengths = [len(seq) - 1 for seq in generate_until_stop(model, X_init, steps, do_sample=True)]
+        print(f"mean sampled length {sum(lengths)/len(lengths):.1f} of at most {steps}")
+        dt_full = timeit(lambda: generate(model, X_init, steps, do_sample=True))
+        dt_stop = timeit(lambda: generate_until_stop(model, X_init, steps, do_sample=True))
+        print(f"generate: {args.num_samples/dt_full:.0f} samples/s, generate_until_stop: {args.num_samples/dt_stop:.0f} samples/s")
+
+def reference_filter(logits, top_k=None, top_p=None):
+    """ top-k as generate used to do it (topk + mask assignment), then top-p by sorting again """
+    logits = logits.clone()
+    if top_k is not None:
+        v, _ = torch.topk(logits, top_k)
+        logits[logits < v[:, [-1]]] = -float('Inf')
+    if top_p is not None:
+        sorted_logits, sorted_idx = torch.sort(logits, dim=-1, descending=True)
+        cum_probs = F.softmax(sorted_logits, dim=-1).cumsum(dim=-1)
+        remove = cum_probs > top_p
+        remove[:, 1:] = remove[:, :-1].clone() # shift right to keep the token that crosses top_p
+        remove[:, 0] = False
+        logits = logits.masked_fill(remove.scatter(1, sorted_idx, remove), -float('Inf'))
+    return logits
+
+def bench_sampling(args):
+    """ vectorized top-k/top-p/disallowed sampling and ragged prefixes vs. the reference """
+    torch.manual_seed(args.seed)
+    b, vocab_size = args.num_samples, 27
+    logits = torch.randn(b, vocab_size) * 3
+
+    # parity: the filters pick the same tokens from the same random draws as the reference
+    for top_k, top_p in [(10, None), (None, 0.9), (10, 0.8)]:
+        torch.manual_seed(args.seed)
+        ref = torch.multinomial(F.softmax(reference_filter(logits, top_k, top_p), dim=-1), num_samples=1)
+        torch.manual_seed(args.seed)
+        new = sample_next(logits, do_sample=True, top_k=top_k, top_p=top_p)
+        assert torch.equal(ref, new), f"top_k={top_k} top_p={top_p} differs from the reference"
+        # per-row parameters that happen to be all equal behave like the scalars
+        torch.manual_seed(args.seed)
+        rows = sample_next(logits, do_sample=True, temperature=torch.ones(b),
+                           top_k=None if top_k is None else torch.full((b,), top_k),
+                           top_p=None if top_p is None else torch.full((b,), top_p))
+        assert torch.equal(rows, new), "per-row parameters differ from the scalar ones"
+    disallowed = torch.zeros(vocab_size, dtype=torch.bool)
+    disallowed[1:14] = True
+    assert not disallowed[sample_next(logits, do_sample=True, disallowed=disallowed)].any(), "sampled a disallowed token"
+    print("top-k, top-p, per-row parameters and disallowed tokens match the reference")
+
+    # parity: greedy completion of prefixes of different lengths in one batch equals completing each alone
+    block_size = 16
+    config = ModelConfig(vocab_size=vocab_size, block_size=block_size, n_layer=2, n_head=4, n_embd=64, n_embd2=64)
+    for name, model in [('transformer', Transformer(config)), ('rnn', RNN(config, cell_type='gru'))]:
+        model.eval()
+        lengths = torch.randint(1, 8, (16,))
+        prefix = torch.randint(1, vocab_size, (16, 8))
+        prefix[:, 0] = 0
+        out = generate(model, prefix, block_size - int(lengths.min()), lengths=lengths)
+        for i in range(16):
+            alone = generate(model, prefix[i:i+1, :lengths[i]], block_size - int(lengths[i]))
+            assert torch.equal(out[i], alone[0]), f"{name}: ragged prefix row {i} differs"
+        ragged = generate_until_stop(model, prefix, block_size - int(lengths.min()), lengths=lengths)
+        for i in range(16):
+            alone = generate_until_stop(model, prefix[i:i+1, :lengths[i]], block_size - int(lengths[i]))
+            assert torch.equal(ragged[i], alone[0]), f"{name}: ragged prefix row {i} differs until stop"
+        print(f"{name}: ragged prefixes in one batch match completing each prefix alone")
+
+    # timing: one sampling step, and whole batches of sampling with the constraints on
+    dt_ref = timeit(lambda: torch.multinomial(F.softmax(reference_filter(logits, 10), dim=-1), num_samples=1))
+    dt_new = timeit(lambda: sample_next(logits, do_sample=True, top_k=10))
+    dt_all = timeit(lambda: sample_next(logits, do_sample=True, temperature=torch.rand(b) + 0.5,
+                                        top_k=torch.randint(1, vocab_size, (b,)), top_p=torch.rand(b), disallowed=disallowed))
+    print(f"sampling step of {b} rows: top-k {dt_ref*1e6:.0f}us reference, {dt_new*1e6:.0f}us sorted, "
+          f"{dt_all*1e6:.0f}us with per-row temperature/top-k/top-p and a disallowed mask")
+    model = Transformer(config).eval()
+    X_init = torch.zeros(b, 1, dtype=torch.long)
+    lengths = torch.randint(1, 4, (b,))
+    prefix = torch.randint(1, vocab_size, (b, 4))
+    prefix[:, 0] = 0
+    dt_plain = timeit(lambda: generate_until_stop(model, X_init, block_size - 1, do_sample=True))
+    dt_constrained = timeit(lambda: generate_until_stop(model, prefix, block_size - 1, do_sample=True, lengths=lengths,
+                                                        temperature=torch.rand(b) + 0.5, top_k=torch.randint(1, vocab_size, (b,)),
+                                                        top_p=torch.rand(b), disallowed=disallowed))
+    print(f"transformer, {b} samples: {b/dt_plain:.0f} samples/s unconstrained, "
+          f"{b/dt_constrained:.0f} samples/s with ragged prefixes and all the constraints")
+
+def bench_quantize(args):
+    """ int8 dynamic quantization and TorchScript export: samples/s, size on disk and test loss """
+    import makemore
+    makemore.args = argparse.Namespace(device='cpu', dtype='fp32') # evaluate() reads these from the script's args
+    train_dataset, test_dataset = create_datasets(args.input_file)
+    config = ModelConfig(vocab_size=train_dataset.get_vocab_size(), block_size=train_dataset.get_output_length(),
+                         n_layer=4, n_head=4, n_embd=64, n_embd2=64)
+    tmp_dir = tempfile.mkdtemp()
+    for model_type in args.types:
+        # a briefly trained model, so that the loss delta means something
+        torch.manual_seed(args.seed)
+        model = create_model(model_type, config)
+        optimizer = torch.optim.AdamW(model.parameters(), lr=5e-4, weight_decay=0.01, betas=(0.9, 0.99), eps=1e-8)
+        loader = InMemoryBatchLoader(train_dataset, batch_size=32, seed=args.seed)
+        for _ in range(args.train_steps):
+            X, Y = loader.next()
+            logits, loss = model(X, Y)
+            model.zero_grad(set_to_none=True)
+            loss.backward()
+            optimizer.step()
+        model.eval()
+        path = os.path.join(tmp_dir, f'{model_type}.pt')
+        torch.save(model.state_dict(), path)
+
+        def load(int8):
+            m = create_model(model_type, config)
+            m.load_state_dict(torch.load(path))
+            return quantize(m.eval()) if int8 else m.eval()
+        variants = {}
+        for int8 in [False, True]:
+            name = 'int8' if int8 else 'fp32'
+            variants[name] = (load(int8), path if not int8 else None)
+            export = os.path.join(tmp_dir, f'{model_type}-{name}.ts.pt')
+            export_model(load(int8), export, config.block_size)
+            variants[name + ' export'] = (ExportedModel(export), export)
+        if variants['int8'][1] is None:
+            int8_path = os.path.join(tmp_dir, f'{model_type}-int8.pt')
+            torch.save(variants['int8'][0].state_dict(), int8_path)
+            variants['int8'] = (variants['int8'][0], int8_path)
+
+        # parity: the exported model matches the model it was traced from, at any batch size, and
+        # at any length in fp32 (int8 picks its activation scales per batch, which the padding shifts)
+        with torch.no_grad():
+            for name, t in [('fp32', 7), ('fp32', config.block_size), ('int8', config.block_size)]:
+                X = torch.randint(0, config.vocab_size, (5, t))
+                max_diff = (variants[name][0](X)[0] - variants[name + ' export'][0](X)[0]).abs().max().item()
+                assert max_diff < 1e-4, f"{model_type}: {name} export differs by {max_diff} at length {t}"
+
+        X_init = torch.zeros(args.num_samples, 1, dtype=torch.long)
+        steps = config.block_size - 1
+        base_loss = None
+        print(f"--- {model_type}")
+        for name, (m, file) in variants.items():
+            with torch.no_grad():
+                torch.manual_seed(args.seed)
+                test_loss = evaluate(m, test_dataset, batch_size=100)
+            base_loss = test_loss if base_loss is None else base_loss
+            dt = timeit(lambda: generate_until_stop(m, X_init, steps, do_sample=True), warmup=1, repeat=3)
+            print(f"{name:12s}: {args.num_samples/dt:6.0f} samples/s | {os.path.getsize(file)/1024:6.0f}KB on disk | "
+                  f"test loss {test_loss:.4f} ({test_loss - base_loss:+.4f})")
+
+def bench_bigram(args):
+    """ bigram fit by counting vs. by gradient descent, and alias-table sampling vs. generate """
+    train_dataset, test_dataset = create_datasets(args.input_file)
+    config = ModelConfig(vocab_size=train_dataset.get_vocab_size(), block_size=train_dataset.get_output_length())
+    X, Y = train_dataset.encode_all()
+    X_test, Y_test = test_dataset.encode_all()
+    def test_loss(model):
+        with torch.no_grad():
+            return model(X_test, Y_test)[1].item()
+
+    # fit: one counting pass vs. the training loop
+    model = Bigram(config)
+    dt_fit = timeit(lambda: model.fit_counts(X, Y, smoothing=args.smoothing), warmup=1, repeat=3)
+    sgd = Bigram(config)
+    optimizer = torch.optim.AdamW(sgd.parameters(), lr=5e-4, weight_decay=0.01, betas=(0.9, 0.99), eps=1e-8)
+    loader = InMemoryBatchLoader(train_dataset, batch_size=32, seed=args.seed)
+    t0 = time.time()
+    for _ in range(args.train_steps):
+        Xb, Yb = loader.next()
+        logits, loss = sgd(Xb, Yb)
+        sgd.zero_grad(set_to_none=True)
+        loss.backward()
+        optimizer.step()
+    dt_sgd = time.time() - t0
+    print(f"counts: {dt_fit*1000:.2f}ms, test loss {test_loss(model):.4f} | "
+          f"{args.train_steps} AdamW steps: {dt_sgd*1000:.0f}ms, test loss {test_loss(sgd):.4f}")
+
+    # parity: the alias tables reproduce the distributions of every row
+    probs = F.softmax(model.logits, dim=-1)
+    n = probs.size(0)
+    rows = torch.arange(n).repeat_interleave(args.num_draws // n)
+    draws = AliasSampler(probs).draw(rows, torch.Generator().manual_seed(args.seed))
+    freq = torch.bincount(rows * n + draws, minlength=n * n).view(n, n).float() / (args.num_draws // n)
+    max_diff = (freq - probs).abs().max().item()
+    assert max_diff < 0.01, f"alias draws are off the distributions by {max_diff}"
+    print(f"alias draw frequencies match the distributions, max abs diff {max_diff:.4f}")
+
+    # timing: num_samples words through the alias tables (and decoded) vs. generate_until_stop
+    steps = config.block_size - 1
+    t0 = time.time()
+    words = train_dataset.decode_many(model.sample(args.num_samples, steps, torch.Generator().manual_seed(args.seed)))
+    dt_alias = time.time() - t0
+    X_init = torch.zeros(args.num_samples, 1, dtype=torch.long)
+    t0 = time.time()
+    X_samp = generate_until_stop(model, X_init, steps, do_sample=True)
+    words_gen = [train_dataset.decode(seq[1:].tolist()) for seq in X_samp]
+    dt_gen = time.time() - t0
+    mean_len = lambda ws: sum(map(len, ws)) / len(ws)
+    print(f"{args.num_samples} words: alias tables {dt_alias:.2f}s ({args.num_samples/dt_alias:.0f}/s), "
+          f"generate {dt_gen:.2f}s ({args.num_samples/dt_gen:.0f}/s) | "
+          f"mean length {mean_len(words):.3f} vs {mean_len(words_gen):.3f}")
+
+def bench_startup(args):
+    """ cold-start time of makemore.py --sample-only/--eval-only, from the sidecar vs. through the corpus """
+    import resource
+    import subprocess
+    def best_times(cmds):
+        """
+        the best CPU time (user + sys) of each command. the commands take turns, so that a
+        drift in the speed of the box hits them all alike
+        """
+        best = [float('inf')] * len(cmds)
+        for _ in range(args.repeat):
+            for i, cmd in enumerate(cmds):
+                r0 = resource.getrusage(resource.RUSAGE_CHILDREN)
+                subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                r1 = resource.getrusage(resource.RUSAGE_CHILDREN)
+                best[i] = min(best[i], r1.ru_utime - r0.ru_utime + r1.ru_stime - r0.ru_stime)
+        return best
+    dt_torch, dt_tensorboard = best_times([[sys.executable, '-c', 'import torch'],
+                                           [sys.executable, '-c', 'import torch; import torch.utils.tensorboard']])
+    print(f"import torch: {dt_torch:.2f}s, with torch.utils.tensorboard: {dt_tensorboard:.2f}s")
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'makemore.py')
+    words = read_words(args.input_file)
+    for repeat in [1, args.corpus_repeat]:
+        # a trained model's work dir (random weights do just as well here), on a corpus of repeat copies of the input
+        work_dir = tempfile.mkdtemp()
+        input_file = os.path.join(work_dir, 'input.txt')
+        with open(input_file, 'w') as f:
+            f.write('\n'.join(words * repeat))
+        train_dataset, test_dataset = create_datasets(input_file)
+        config = ModelConfig(vocab_size=train_dataset.get_vocab_size(), block_size=train_dataset.get_output_length(),
+                             n_layer=4, n_head=4, n_embd=64, n_embd2=64)
+        torch.save(create_model(args.type, config).state_dict(), os.path.join(work_dir, 'model.pt'))
+        save_meta(work_dir, args.type, config, train_dataset, test_dataset)
+        # the same work dir without the sidecar goes through the corpus
+        corpus_dir = tempfile.mkdtemp()
+        os.symlink(os.path.join(work_dir, 'model.pt'), os.path.join(corpus_dir, 'model.pt'))
+        for flag in ['--sample-only', '--eval-only']:
+            cmd = [sys.executable, script, '--type', args.type, flag]
+            cmds = [cmd + ['-o', work_dir], cmd + ['-o', corpus_dir, '-i', input_file]]
+            if flag == '--sample-only': # -i reads the corpus again, only to report the novel samples
+                cmds.append(cmd + ['-o', work_dir, '-i', input_file])
+            dts = best_times(cmds)
+            print(f"{len(words) * repeat} words, {flag}: {dts[0]:.2f}s from the sidecar, {dts[1]:.2f}s through the corpus"
+                  + (f", {dts[2]:.2f}s from the sidecar with -i" if len(dts) > 2 else ""))
+
+def bench_phases(args):
+    """ where a training step of each model type spends its time, per phase """
+    train_dataset, _ = create_datasets(args.input_file)
+    config = ModelConfig(vocab_size=train_dataset.get_vocab_size(), block_size=train_dataset.get_output_length(),
+                         n_layer=4, n_head=4, n_embd=64, n_embd2=64)
+    loader = InMemoryBatchLoader(train_dataset, batch_size=args.batch_size, seed=args.seed)
+    print(f"{'':12s} {'data':>8s} {'h2d':>8s} {'forward':>8s} {'backward':>8s} {'optimizer':>9s} {'total':>8s} (ms/step)")
+    for model_type in args.types:
+        torch.manual_seed(args.seed)
+        model = create_model(model_type, config)
+        optimizer = torch.optim.AdamW(model.parameters(), lr=5e-4, weight_decay=0.01, betas=(0.9, 0.99), eps=1e-8)
+        timer = PhaseTimer('cpu')
+        for i in range(args.warmup + args.steps):
+            if i == args.warmup:
+                timer.read() # drop the warm-up steps
+            with timer.phase('data'):
+                batch = loader.next()
+            with timer.phase('h2d'):
+                X, Y = [t.to('cpu') for t in batch]
+            with timer.phase('forward'):
+                logits, loss = model(X, Y)
+            with timer.phase('backward'):
+                model.zero_grad(set_to_none=True)
+                loss.backward()
+            with timer.phase('optimizer'):
+                optimizer.step()
+            timer.step()
+        ms = timer.read()
+        print(f"{model_type:12s} {ms['data']:8.2f} {ms['h2d']:8.2f} {ms['forward']:8.2f} {ms['backward']:8.2f} "
+              f"{ms['optimizer']:9.2f} {sum(ms.values()):8.2f}")
+
+def run_suite_config(cfg):
+    """ measures one configuration of the suite, in a fresh process so that its peak RSS is its own """
+    import resource
+    torch.manual_seed(cfg['seed'])
+    rss_base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # MB on Linux, after importing torch
+    config = ModelConfig(vocab_size=27, block_size=cfg['block_size'], n_layer=cfg['n_layer'], n_head=4,
+                         n_embd=cfg['n_embd'], n_embd2=cfg['n_embd'])
+    model = create_model(cfg['type'], config).to(cfg['device'])
+    b, t = cfg['batch_size'], cfg['block_size']
+    X = torch.randint(0, config.vocab_size, (b, t), device=cfg['device'])
+    Y = torch.randint(0, config.vocab_size, (b, t), device=cfg['device'])
+    def sync():
+        if cfg['device'].startswith('cuda'):
+            torch.cuda.synchronize()
+    def forward():
+        with torch.no_grad():
+            model(X, Y)
+        sync()
+    def forward_backward():
+        model.zero_grad(set_to_none=True)
+        _, loss = model(X, Y)
+        loss.backward()
+        sync()
+    X_init = torch.zeros(b, 1, dtype=torch.long, device=cfg['device'])
+    def sample():
+        generate(model, X_init, t - 1, do_sample=True)
+        sync()
+    model.train()
+    dt_fwd = timeit(forward, repeat=cfg['repeat'])
+    dt_fwdbwd = timeit(forward_backward, repeat=cfg['repeat'])
+    model.eval()
+    dt_gen = timeit(sample, warmup=1, repeat=cfg['repeat'])
+    result = dict(cfg, params=sum(p.numel() for p in model.parameters()),
+                  forward_tok_s=b * t / dt_fwd, fwdbwd_tok_s=b * t / dt_fwdbwd, generate_samples_s=b / dt_gen,
+                  peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, base_rss_mb=rss_base)
+    if cfg['device'].startswith('cuda'):
+        result['peak_cuda_mb'] = torch.cuda.max_memory_allocated() / 2**20
+    return result
+
+def bench_suite(args):
+    """ forward, forward+backward and generate throughput and peak memory of every model type and size """
+    import json
+    import platform
+    import subprocess
+    if args.worker is not None: # a child process of the suite, measuring one configuration
+        print(json.dumps(run_suite_config(json.loads(args.worker))))
+        return
+    configs = []
+    for model_type in args.types:
+        # the bigram has no layers or channels, one size covers it
+        sizes = args.sizes[:1] if model_type == 'bigram' else args.sizes
+        for size in sizes:
+            n_layer, n_embd = map(int, size.split('x'))
+            for block_size in args.block_sizes:
+                for batch_size in args.batch_sizes:
+                    configs.append(dict(type=model_type, n_layer=n_layer, n_embd=n_embd, block_size=block_size,
+                                        batch_size=batch_size, device=args.device, seed=args.seed, repeat=args.repeat))
+    baseline = {}
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            baseline = {suite_key(r): r for r in json.load(f)['results']}
+
+    env = dict(os.environ)
+    if args.threads is not None:
+        env['OMP_NUM_THREADS'] = str(args.threads)
+    results = []
+    print(f"{'type':12s} {'size':>6s} {'T':>4s} {'B':>5s} {'params':>8s} {'fwd tok/s':>10s} {'f+b tok/s':>10s} "
+          f"{'gen smp/s':>10s} {'peak MB':>8s} {'(+model)':>8s}" + ("  vs baseline (f+b, gen)" if baseline else ""))
+    for cfg in configs:
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), 'suite', '--worker', json.dumps(cfg)],
+                             check=True, capture_output=True, text=True, env=env)
+        r = json.loads(out.stdout.strip().splitlines()[-1])
+        results.append(r)
+        line = (f"{r['type']:12s} {r['n_layer']:>2d}x{r['n_embd']:<3d} {r['block_size']:4d} {r['batch_size']:5d} "
+                f"{r['params']:8d} {r['forward_tok_s']:10.0f} {r['fwdbwd_tok_s']:10.0f} {r['generate_samples_s']:10.0f} "
+                f"{r['peak_rss_mb']:8.0f} {r['peak_rss_mb'] - r['base_rss_mb']:+8.0f}")
+        old = baseline.get(suite_key(r))
+        if old is not None:
+            line += f"  {r['fwdbwd_tok_s']/old['fwdbwd_tok_s']:5.2f}x {r['generate_samples_s']/old['generate_samples_s']:5.2f}x"
+        print(line, flush=True)
+
+    meta = dict(torch=torch.__version__, python=platform.python_version(), machine=platform.machine(),
+                cpu_count=os.cpu_count(), threads=args.threads, time=time.strftime('%Y-%m-%dT%H:%M:%S'))
+    with open(args.out, 'w') as f:
+        json.dump(dict(meta=meta, results=results), f, indent=1)
+    print(f"wrote {len(results)} results to {args.out}")
+
+def suite_key(r):
+    """ identifies a configuration across results files """
+    return (r['type'], r['n_layer'], r['n_embd'], r['block_size'], r['batch_size'], r['device'])
+
+def bench_dataset(args):
+    """ startup and per-item cost of the text dataset vs. the pre-tokenized memory-mapped one """
+    for pretokenized in [False, True]:
+        if pretokenized:
+            create_datasets(args.input_file, pretokenized=True) # build the preprocessed file up front
+        t0 = time.time()
+        train_dataset, _ = create_datasets(args.input_file, pretokenized=pretokenized)
+        t1 = time.time()
+        dt = timeit(lambda: [train_dataset[i] for i in range(len(train_dataset))], warmup=1, repeat=3)
+        print(f"pretokenized={pretokenized}: create_datasets {(t1-t0)*1000:.1f}ms, "
+              f"{len(train_dataset)/dt:.0f} items/s from __getitem__")
+
+def bench_loader(args):
+    """ training step time with the DataLoader-based vs. the in-memory gather batch loader """
+    train_dataset, _ = create_datasets(args.input_file)
+    config = ModelConfig(vocab_size=train_dataset.get_vocab_size(), block_size=train_dataset.get_output_length(),
+                         n_layer=4, n_head=4, n_embd=64, n_embd2=64)
+    models = {'transformer': Transformer, 'gru': lambda c: RNN(c, 'gru'), 'bow': BoW}
+    print(f"{'model':>12} {'batch':>6} {'dataloader':>12} {'memory':>12}   (ms per step)")
+    for batch_size in args.batch_sizes:
+        loaders = {
+            'dataloader': InfiniteDataLoader(train_dataset, batch_size=batch_size, num_workers=args.num_workers),
+            'memory': InMemoryBatchLoader(train_dataset, batch_size=batch_size),
+        }
+        for name, model_fn in models.items():
+            torch.manual_seed(args.seed)
+            model = model_fn(config)
+            optimizer = torch.optim.AdamW(model.parameters(), lr=5e-4)
+            times = {}
+            for loader_name, loader in loaders.items():
+                def train_steps():
+                    for _ in range(args.steps):
+                        X, Y = loader.next()
+                        logits, loss = model(X, Y)
+                        model.zero_grad(set_to_none=True)
+                        loss.backward()
+                        optimizer.step()
+                times[loader_name] = timeit(train_steps, warmup=1, repeat=3) / args.steps
+            print(f"{name:>12} {batch_size:>6} {times['dataloader']*1000:>12.2f} {times['memory']*1000:>12.2f}")
+
+def bench_attention(args):
+    """ fused scaled_dot_product_attention vs. the explicit (T, T) attention in the Transformer """
+    for block_size in args.block_sizes:
+        config = ModelConfig(vocab_size=27, block_size=block_size, n_layer=4, n_head=4, n_embd=64)
+        models = {}
+        for attn_impl in ['explicit', 'sdpa']:
+            torch.manual_seed(args.seed) # same weights for both
+            config.attn_impl = attn_impl
+            models[attn_impl] = Transformer(config)
+        X = torch.randint(0, config.vocab_size, (args.batch_size, block_size))
+        Y = torch.randint(0, config.vocab_size, (args.batch_size, block_size))
+
+        # parity: logits, loss and gradients must agree
+        results = {}
+        for attn_impl, model in models.items():
+            logits, loss = model(X, Y)
+            loss.backward()
+            results[attn_impl] = (logits, model.transformer.wte.weight.grad)
+        logit_diff = (results['explicit'][0] - results['sdpa'][0]).abs().max().item()
+        grad_diff = (results['explicit'][1] - results['sdpa'][1]).abs().max().item()
+        assert torch.allclose(results['explicit'][0], results['sdpa'][0], atol=1e-4), "sdpa logits diverge"
+        assert torch.allclose(results['explicit'][1], results['sdpa'][1], atol=1e-4), "sdpa gradients diverge"
+
+        # parity: cached sampling goes through the masked and unmasked sdpa calls
+        X_init = torch.zeros(16, 1, dtype=torch.long)
+        assert torch.equal(generate(models['explicit'].eval(), X_init, block_size - 1),
+                           generate(models['sdpa'].eval(), X_init, block_size - 1)), "sdpa samples differ"
+
+        times = {}
+        for attn_impl, model in models.items():
+            model.train()
+            def fwd_bwd():
+                logits, loss = model(X, Y)
+                model.zero_grad(set_to_none=True)
+                loss.backward()
+            times[attn_impl] = timeit(fwd_bwd)
+        print(f"block_size {block_size}: max abs diff logits {logit_diff:.1e} grads {grad_diff:.1e} | "
+              f"forward+backward explicit {times['explicit']*1000:.2f}ms, sdpa {times['sdpa']*1000:.2f}ms")
+
+def bench_bow(args):
+    """ prefix-sum CausalBoW vs. the masked (T, T) softmax average, alone and inside BoW """
+    for block_size in args.block_sizes:
+        config = ModelConfig(vocab_size=27, block_size=block_size, n_embd=64, n_embd2=64)
+        x = torch.randn(args.batch_size, block_size, config.n_embd)
+        X = torch.randint(0, config.vocab_size, (args.batch_size, block_size))
+        Y = torch.randint(0, config.vocab_size, (args.batch_size, block_size))
+        cbows, models, times = {}, {}, {}
+        for bow_impl in ['softmax', 'cumsum']:
+            config.bow_impl = bow_impl
+            cbows[bow_impl] = CausalBoW(config)
+            torch.manual_seed(args.seed) # same weights for both
+            models[bow_impl] = BoW(config)
+        with torch.no_grad():
+            y_ref, y = cbows['softmax'](x), cbows['cumsum'](x)
+            logits_ref, logits = models['softmax'](X)[0], models['cumsum'](X)[0]
+        assert torch.allclose(y_ref, y, atol=1e-5), "cumsum CausalBoW diverges from the softmax average"
+        assert torch.allclose(logits_ref, logits, atol=1e-4), "cumsum BoW logits diverge"
+        for bow_impl in ['softmax', 'cumsum']:
+            def fwd_bwd():
+                logits, loss = models[bow_impl](X, Y)
+                models[bow_impl].zero_grad(set_to_none=True)
+                loss.backward()
+            with torch.no_grad():
+                t_cbow = timeit(lambda: cbows[bow_impl](x))
+            times[bow_impl] = (t_cbow, timeit(fwd_bwd))
+        print(f"block_size {block_size}: max abs diff {(y_ref - y).abs().max().item():.1e} | CausalBoW forward "
+              f"softmax {times['softmax'][0]*1000:.2f}ms, cumsum {times['cumsum'][0]*1000:.2f}ms | BoW forward+backward "
+              f"softmax {times['softmax'][1]*1000:.2f}ms, cumsum {times['cumsum'][1]*1000:.2f}ms")
+
+def mlp_context_loop(model, idx):
+    """ the original MLP context gather: one embedding lookup and torch.roll per offset """
+    embs = []
+    for k in range(model.block_size):
+        tok_emb = model.wte(idx) # token embeddings of shape (b, t, n_embd)
+        idx = torch.roll(idx, 1, 1)
+        idx[:, 0] = model.vocab_size # special <BLANK> token
+        embs.append(tok_emb)
+    return model.mlp(torch.cat(embs, -1))
+
+def bench_mlp(args):
+    """ single-lookup unfold context of the MLP model vs. the per-offset roll loop """
+    for block_size in args.block_sizes:
+        config = ModelConfig(vocab_size=27, block_size=block_size, n_embd=64, n_embd2=64)
+        torch.manual_seed(args.seed)
+        model = MLP(config)
+        X = torch.randint(0, config.vocab_size, (args.batch_size, block_size))
+        Y = torch.randint(0, config.vocab_size, (args.batch_size, block_size))
+        with torch.no_grad():
+            logits_ref, logits = mlp_context_loop(model, X.clone()), model(X)[0]
+        assert torch.equal(logits_ref, logits), "unfold MLP context differs from the roll loop"
+        def fwd_bwd(forward):
+            loss = F.cross_entropy(forward().view(-1, config.vocab_size), Y.view(-1))
+            model.zero_grad(set_to_none=True)
+            loss.backward()
+        t_loop = timeit(lambda: fwd_bwd(lambda: mlp_context_loop(model, X.clone())))
+        t_unfold = timeit(lambda: fwd_bwd(lambda: model(X)[0]))
+        print(f"block_size {block_size}: forward+backward roll loop {t_loop*1000:.2f}ms, unfold {t_unfold*1000:.2f}ms")
+
+def bench_rnn(args):
+    """ fused-input-projection RNN/GRU recurrence vs. one cell call per timestep """
+    config = ModelConfig(vocab_size=27, block_size=args.block_size, n_embd=args.n_embd, n_embd2=args.n_embd2)
+    X = torch.randint(0, config.vocab_size, (args.batch_size, args.block_size))
+    Y = torch.randint(0, config.vocab_size, (args.batch_size, args.block_size))
+    for cell_type in ['rnn', 'gru']:
+        models, times = {}, {}
+        for rnn_impl in ['cell', 'fused']:
+            torch.manual_seed(args.seed) # same weights for both
+            config.rnn_impl = rnn_impl
+            models[rnn_impl] = RNN(config, cell_type)
+        # parity: the fused path must use the very same parameters and compute the same function
+        models['fused'].load_state_dict(models['cell'].state_dict())
+        grads = {}
+        for rnn_impl, model in models.items():
+            logits, loss = model(X, Y)
+            loss.backward()
+            grads[rnn_impl] = (logits, [p.grad for p in model.parameters()])
+        assert torch.allclose(grads['cell'][0], grads['fused'][0], atol=1e-5), "fused logits diverge"
+        for g_ref, g in zip(grads['cell'][1], grads['fused'][1]):
+            assert torch.allclose(g_ref, g, atol=1e-5), "fused gradients diverge"
+        # the same under bf16 autocast, where the matmuls run in bf16 and the hidden state starts in fp32
+        with autocast('cpu', 'bf16'):
+            logits_bf16 = {rnn_impl: model(X, Y)[0] for rnn_impl, model in models.items()}
+            models['fused'](X, Y)[1].backward() # and the backward pass runs too
+        assert torch.allclose(logits_bf16['cell'].float(), logits_bf16['fused'].float(), atol=5e-2), "bf16 fused logits diverge"
+        for rnn_impl, model in models.items():
+            optimizer = torch.optim.AdamW(model.parameters(), lr=5e-4)
+            def train_step():
+                logits, loss = model(X, Y)
+                model.zero_grad(set_to_none=True)
+                loss.backward()
+                optimizer.step()
+            times[rnn_impl] = timeit(train_step)
+        print(f"{cell_type}: max abs logit diff {(grads['cell'][0] - grads['fused'][0]).abs().max().item():.1e} | "
+              f"bf16 {(logits_bf16['cell'].float() - logits_bf16['fused'].float()).abs().max().item():.1e} | "
+              f"training step cell {times['cell']*1000:.2f}ms, fused {times['fused']*1000:.2f}ms")
+
+def bench_buckets(args):
+    """ padding and training step time of length-bucketed batches vs. full-length batches """
+    train_dataset, _ = create_datasets(args.input_file)
+    # a skewed corpus: the same words plus a handful of very long outliers
+    torch.manual_seed(args.seed)
+    outliers = [''.join(train_dataset.chars[i] for i in torch.randint(len(train_dataset.chars), (args.outlier_length,)).tolist())
+                for _ in range(10)]
+    skewed_dataset = CharDataset(train_dataset.words + outliers, train_dataset.chars, args.outlier_length)
+    for name, dataset in [(args.input_file, train_dataset), ('skewed', skewed_dataset)]:
+        config = ModelConfig(vocab_size=dataset.get_vocab_size(), block_size=dataset.get_output_length(),
+                             n_layer=4, n_head=4, n_embd=64, n_embd2=64)
+        loaders = {
+            'memory': InMemoryBatchLoader(dataset, batch_size=args.batch_size),
+            'bucketed': BucketedBatchLoader(dataset, batch_size=args.batch_size, bucket_width=args.bucket_width),
+        }
+        times = {}
+        for loader_name, loader in loaders.items():
+            torch.manual_seed(args.seed)
+            model = Transformer(config)
+            optimizer = torch.optim.AdamW(model.parameters(), lr=5e-4)
+            def train_steps():
+                for _ in range(args.steps):
+                    X, Y = loader.next()
+                    logits, loss = model(X, Y)
+                    model.zero_grad(set_to_none=True)
+                    loss.backward()
+                    optimizer.step()
+            times[loader_name] = timeit(train_steps, warmup=1, repeat=3) / args.steps
+        print(f"{name}: padded/real tokens {padding_ratio(dataset):.2f} at full length, "
+              f"{loaders['bucketed'].padding_ratio():.2f} bucketed | transformer step time "
+              f"{times['memory']*1000:.2f}ms full length, {times['bucketed']*1000:.2f}ms bucketed")
+
+# -----------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="makemore benchmarks")
+    parser.add_argument('--seed', type=int, default=3407, help="seed")
+    subparsers = parser.add_subparsers(dest='bench', required=True)
+    p = subparsers.add_parser('kvcache', help=bench_kvcache.__doc__)
+    p.add_argument('--block-size', type=int, default=16, help="length of the sampled sequences")
+    p.add_argument('--num-samples', type=int, default=500, help="number of sequences sampled in one batch")
+    p.set_defaults(fn=bench_kvcache)
+    p = subparsers.add_parser('rnnstep', help=bench_rnnstep.__doc__)
+    p.add_argument('--block-size', type=int, default=16, help="length of the sampled sequences")
+    p.add_argument('--num-samples', type=int, default=500, help="number of sequences sampled in one batch")
+    p.set_defaults(fn=bench_rnnstep)
+    p = subparsers.add_parser('earlystop', help=bench_earlystop.__doc__)
+    p.add_argument('--block-size', type=int, default=32, help="maximum length of the sampled sequences")
+    p.add_argument('--num-samples', type=int, default=2000, help="number of sequences sampled in one batch")
+    p.add_argument('--stop-bias', type=float, default=1.0, help="logit bias of the <STOP> token, sets the typical length")
+    p.set_defaults(fn=bench_earlystop)
+    p = subparsers.add_parser('sampling', help=bench_sampling.__doc__)
+    p.add_argument('--num-samples', type=int, default=500, help="number of sequences sampled in one batch")
+    p.set_defaults(fn=bench_sampling)
+    p = subparsers.add_parser('quantize', help=bench_quantize.__doc__)
+    p.add_argument('--input-file', '-i', type=str, default='names.txt', help="input file with things one per line")
+    p.add_argument('--types', type=str, nargs='+', default=['transformer', 'mlp', 'gru'], help="model types to quantize")
+    p.add_argument('--train-steps', type=int, default=300, help="training steps before quantizing")
+    p.add_argument('--num-samples', type=int, default=500, help="number of sequences sampled in one batch")
+    p.set_defaults(fn=bench_quantize)
+    p = subparsers.add_parser('bigram', help=bench_bigram.__doc__)
+    p.add_argument('--input-file', '-i', type=str, default='names.txt', help="input file with things one per line")
+    p.add_argument('--smoothing', type=float, default=1.0, help="pseudo-count added to every character pair")
+    p.add_argument('--train-steps', type=int, default=2000, help="AdamW steps of the gradient descent fit")
+    p.add_argument('--num-draws', type=int, default=10_000_000, help="draws of the alias table parity check")
+    p.add_argument('--num-samples', type=int, default=1_000_000, help="number of words sampled")
+    p.set_defaults(fn=bench_bigram)
+    p = subparsers.add_parser('startup', help=bench_startup.__doc__)
+    p.add_argument('--input-file', '-i', type=str, default='names.txt', help="input file with things one per line")
+    p.add_argument('--type', type=str, default='transformer', help="model class type to use")
+    p.add_argument('--corpus-repeat', type=int, default=30, help="copies of the input file in the large corpus")
+    p.add_argument('--repeat', type=int, default=3, help="runs per timing, the best one counts")
+    p.set_defaults(fn=bench_startup)
+    p = subparsers.add_parser('phases', help=bench_phases.__doc__)
+    p.add_argument('--input-file', '-i', type=str, default='names.txt', help="input file with things one per line")
+    p.add_argument('--types', type=str, nargs='+', default=['bigram', 'mlp', 'rnn', 'gru', 'bow', 'transformer'], help="model types to time")
+    p.add_argument('--batch-size', '-b', type=int, default=32, help="batch size")
+    p.add_argument('--warmup', type=int, default=5, help="untimed steps first")
+    p.add_argument('--steps', type=int, default=50, help="timed training steps")
+    p.set_defaults(fn=bench_phases)
+    p = subparsers.add_parser('suite', help=bench_suite.__doc__)
+    p.add_argument('--types', type=str, nargs='+', default=['bigram', 'mlp', 'rnn', 'gru', 'bow', 'transformer'], help="model types to run")
+    p.add_argument('--sizes', type=str, nargs='+', default=['2x32', '4x64'], help="model sizes as n_layer x n_embd (n_embd2 = n_embd)")
+    p.add_argument('--block-sizes', type=int, nargs='+', default=[16, 32], help="sequence lengths")
+    p.add_argument('--batch-sizes', type=int, nargs='+', default=[32, 256], help="batch sizes")
+    p.add_argument('--device', type=str, default='cpu', help="device to use for compute, examples: cpu|cuda|cuda:2|mps")
+    p.add_argument('--threads', type=int, default=None, help="OMP_NUM_THREADS of the measuring processes, default: torch's own choice")
+    p.add_argument('--repeat', type=int, default=5, help="timed runs per measurement, the best one counts")
+    p.add_argument('--out', type=str, default='bench_results.json', help="results file to write")
+    p.add_argument('--compare', type=str, default=None, help="earlier results file to report the speedups against")
+    p.add_argument('--worker', type=str, default=None, help=argparse.SUPPRESS)
+    p.set_defaults(fn=bench_suite)
+    p = subparsers.add_parser('dataset', help=bench_dataset.__doc__)
+    p.add_argument('--input-file', '-i', type=str, default='names.txt', help="input file with things one per line")
+    p.set_defaults(fn=bench_dataset)
+    p = subparsers.add_parser('loader', help=bench_loader.__doc__)
+    p.add_argument('--input-file', '-i', type=str, default='names.txt', help="input file with things one per line")
+    p.add_argument('--batch-sizes', type=int, nargs='+', default=[32, 256, 1024, 4096], help="batch sizes to time")
+    p.add_argument('--num-workers', '-n', type=int, default=0, help="number of DataLoader workers")
+    p.add_argument('--steps', type=int, default=10, help="training steps per timing")
+    p.set_defaults(fn=bench_loader)
+    p = subparsers.add_parser('buckets', help=bench_buckets.__doc__)
+    p.add_argument('--input-file', '-i', type=str, default='names.txt', help="input file with things one per line")
+    p.add_argument('--batch-size', '-b', type=int, default=256, help="batch size")
+    p.add_argument('--bucket-width', type=int, default=4, help="range of word lengths that share a bucket")
+    p.add_argument('--outlier-length', type=int, default=64, help="length of the outlier words of the skewed corpus")
+    p.add_argument('--steps', type=int, default=10, help="training steps per timing")
+    p.set_defaults(fn=bench_buckets)
+    p = subparsers.add_parser('attention', help=bench_attention.__doc__)
+    p.add_argument('--block-sizes', type=int, nargs='+', default=[16, 64, 256, 512], help="sequence lengths to time")
+    p.add_argument('--batch-size', '-b', type=int, default=32, help="batch size")
+    p.set_defaults(fn=bench_attention)
+    p = subparsers.add_parser('bow', help=bench_bow.__doc__)
+    p.add_argument('--block-sizes', type=int, nargs='+', default=[16, 64, 256, 1024], help="sequence lengths to time")
+    p.add_argument('--batch-size', '-b', type=int, default=32, help="batch size")
+    p.set_defaults(fn=bench_bow)
+    p = subparsers.add_parser('mlp', help=bench_mlp.__doc__)
+    p.add_argument('--block-sizes', type=int, nargs='+', default=[4, 16, 64, 128], help="context lengths to time")
+    p.add_argument('--batch-size', '-b', type=int, default=32, help="batch size")
+    p.set_defaults(fn=bench_mlp)
+    p = subparsers.add_parser('rnn', help=bench_rnn.__doc__)
+    p.add_argument('--block-size', type=int, default=16, help="sequence length")
+    p.add_argument('--batch-size', '-b', type=int, default=32, help="batch size")
+    p.add_argument('--n-embd', type=int, default=64, help="number of input feature channels")
+    p.add_argument('--n-embd2', type=int, default=64, help="number of hidden state channels")
+    p.set_defaults(fn=bench_rnn)
+    args = parser.parse_args()
+    args.fn(args)
@@ -14,10 +14,16 @@ Changes from minGPT:
 
 import os
 import sys
+import json
+import glob
 import time
 import math
 import argparse
-from dataclasses import dataclass
+import threading
+import functools
+import contextlib
+import concurrent.futures
+from dataclasses import dataclass, asdict
 from typing import List
 
 import torch
@@ -25,7 +31,6 @@ import torch.nn as nn
 from torch.nn import functional as F
 from torch.utils.data import Dataset
 from torch.utils.data.dataloader import DataLoader
-from torch.utils.tensorboard import SummaryWriter
 
 # -----------------------------------------------------------------------------
 
@@ -38,6 +43,15 @@ class ModelConfig:
     n_embd: int = 64
     n_embd2: int = 64
     n_head: int = 4
+    # implementation of the causal self-attention in the Transformer: 'sdpa' uses the fused
+    # F.scaled_dot_product_attention (if this PyTorch has it), 'explicit' the T x T matrix below
+    attn_impl: str = 'sdpa'
+    # implementation of the causal average in the BoW: 'cumsum' divides a prefix sum by the
+    # position, 'softmax' softmaxes a masked T x T matrix like an attention layer would
+    bow_impl: str = 'cumsum'
+    # implementation of the RNN/GRU recurrence: 'fused' projects the inputs of all timesteps
+    # up front and keeps only the hidden state matmuls in the loop, 'cell' calls the cell per step
+    rnn_impl: str = 'fused'
 
 # -----------------------------------------------------------------------------
 # Transformer Language Model (*exactly* as used in GPT-2)
@@ -69,8 +83,10 @@ class CausalSelfAttention(nn.Module):
                                      .view(1, 1, config.block_size, config.block_size))
         self.n_head = config.n_head
         self.n_embd = config.n_embd
+        assert config.attn_impl in ('sdpa', 'explicit'), f"unknown attention implementation {config.attn_impl}"
+        self.use_sdpa = config.attn_impl == 'sdpa' and hasattr(F, 'scaled_dot_product_attention')
 
-    def forward(self, x):
+    def forward(self, x, kv_cache=None, layer=0):
         B, T, C = x.size() # batch size, sequence length, embedding dimensionality (n_embd)
 
         # calculate query, key, values for all heads in batch and move head forward to be the batch dim
@@ -79,11 +95,26 @@ class CausalSelfAttention(nn.Module):
         q = q.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
         v = v.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
 
-        # causal self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, T) -> (B, nh, T, T)
-        att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
-        att = att.masked_fill(self.bias[:,:,:T,:T] == 0, float('-inf'))
-        att = F.softmax(att, dim=-1)
-        y = att @ v # (B, nh, T, T) x (B, nh, T, hs) -> (B, nh, T, hs)
+        # during incremental decoding prepend the keys and values of all the earlier positions
+        if kv_cache is not None:
+            k, v = kv_cache.update(layer, k, v) # (B, nh, Tk, hs) where Tk = T_past + T
+        Tk = k.size(2)
+
+        if self.use_sdpa:
+            # fused kernel that never materializes the (T, Tk) attention matrix. its is_causal
+            # mask is aligned to the top left, which is only right without cached positions
+            if Tk == T:
+                y = F.scaled_dot_product_attention(q, k, v, is_causal=True)
+            elif T == 1:
+                y = F.scaled_dot_product_attention(q, k, v) # a single new token sees all positions
+            else:
+                y = F.scaled_dot_product_attention(q, k, v, attn_mask=self.bias[:,:,Tk-T:Tk,:Tk] != 0)
+        else:
+            # causal self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, Tk) -> (B, nh, T, Tk)
+            att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
+            att = att.masked_fill(self.bias[:,:,Tk-T:Tk,:Tk] == 0, float('-inf'))
+            att = F.softmax(att, dim=-1)
+            y = att @ v # (B, nh, T, Tk) x (B, nh, Tk, hs) -> (B, nh, T, hs)
         y = y.transpose(1, 2).contiguous().view(B, T, C) # re-assemble all head outputs side by side
 
         # output projection
@@ -106,11 +137,38 @@ class Block(nn.Module):
         m = self.mlp
         self.mlpf = lambda x: m.c_proj(m.act(m.c_fc(x))) # MLP forward
 
-    def forward(self, x):
-        x = x + self.attn(self.ln_1(x))
+    def forward(self, x, kv_cache=None, layer=0):
+        x = x + self.attn(self.ln_1(x), kv_cache, layer)
         x = x + self.mlpf(self.ln_2(x))
         return x
 
+class KVCache:
+    """
+    the keys and values of every attention layer for all the positions decoded so far.
+    when sampling, this lets each new token attend to the whole prefix while only the
+    newest token is forwarded through the Transformer.
+    """
+
+    def __init__(self, n_layer):
+        self.k = [None] * n_layer # per layer tensor of shape (B, nh, T, hs)
+        self.v = [None] * n_layer
+
+    def __len__(self):
+        return 0 if self.k[0] is None else self.k[0].size(2) # number of cached positions
+
+    def update(self, layer, k, v):
+        """ appends the new keys/values of a layer and returns the ones of the whole sequence """
+        if self.k[layer] is not None:
+            k = torch.cat((self.k[layer], k), dim=2)
+            v = torch.cat((self.v[layer], v), dim=2)
+        self.k[layer], self.v[layer] = k, v
+        return k, v
+
+    def select(self, rows):
+        """ keeps only the given rows of the batch, e.g. once some sequences finished """
+        self.k = [k if k is None else k[rows] for k in self.k]
+        self.v = [v if v is None else v[rows] for v in self.v]
+
 class Transformer(nn.Module):
     """ Transformer Language Model, exactly as seen in GPT-2 """
 
@@ -133,18 +191,23 @@ class Transformer(nn.Module):
     def get_block_size(self):
         return self.block_size
 
-    def forward(self, idx, targets=None):
+    def init_kv_cache(self):
+        return KVCache(len(self.transformer.h))
+
+    def forward(self, idx, targets=None, kv_cache=None):
         device = idx.device
         b, t = idx.size()
-        assert t <= self.block_size, f"Cannot forward sequence of length {t}, block size is only {self.block_size}"
-        pos = torch.arange(0, t, dtype=torch.long, device=device).unsqueeze(0) # shape (1, t)
+        # when a kv_cache is given, idx holds only the tokens that follow the cached positions
+        t_past = 0 if kv_cache is None else len(kv_cache)
+        assert t_past + t <= self.block_size, f"Cannot forward sequence of length {t_past + t}, block size is only {self.block_size}"
+        pos = torch.arange(t_past, t_past + t, dtype=torch.long, device=device).unsqueeze(0) # shape (1, t)
 
         # forward the GPT model itself
         tok_emb = self.transformer.wte(idx) # token embeddings of shape (b, t, n_embd)
         pos_emb = self.transformer.wpe(pos) # position embeddings of shape (1, t, n_embd)
         x = tok_emb + pos_emb
-        for block in self.transformer.h:
-            x = block(x)
+        for i, block in enumerate(self.transformer.h):
+            x = block(x, kv_cache, i)
         x = self.transformer.ln_f(x)
         logits = self.lm_head(x)
 
@@ -170,15 +233,23 @@ class CausalBoW(nn.Module):
         self.block_size = config.block_size
         self.register_buffer("bias", torch.tril(torch.ones(config.block_size, config.block_size))
                             .view(1, config.block_size, config.block_size))
+        assert config.bow_impl in ('cumsum', 'softmax'), f"unknown BoW implementation {config.bow_impl}"
+        self.bow_impl = config.bow_impl
 
     def forward(self, x):
         B, T, C = x.size() # batch size, sequence length, n_embd
 
-        # do the weighted average of all preceeding token features
-        att = torch.zeros((B, T, T), device=x.device)
-        att = att.masked_fill(self.bias[:,:T,:T] == 0, float('-inf'))
-        att = F.softmax(att, dim=-1)
-        y = att @ x # (B, T, T) x (B, T, C) -> (B, T, C)
+        if self.bow_impl == 'cumsum':
+            # the uniform average of the preceeding token features is their running sum
+            # divided by the count, O(T*C) and without any (T, T) matrix
+            n = torch.arange(1, T + 1, dtype=x.dtype, device=x.device).view(1, T, 1)
+            y = x.cumsum(dim=1) / n # (B, T, C)
+        else:
+            # do the weighted average of all preceeding token features
+            att = torch.zeros((B, T, T), device=x.device)
+            att = att.masked_fill(self.bias[:,:T,:T] == 0, float('-inf'))
+            att = F.softmax(att, dim=-1)
+            y = att @ x # (B, T, T) x (B, T, C) -> (B, T, C)
 
         return y
 
@@ -267,6 +338,7 @@ class RNNCell(nn.Module):
     """
     def __init__(self, config):
         super().__init__()
+        self.n_embd = config.n_embd
         self.xh_to_h = nn.Linear(config.n_embd + config.n_embd2, config.n_embd2)
 
     def forward(self, xt, hprev):
@@ -274,6 +346,20 @@ class RNNCell(nn.Module):
         ht = F.tanh(self.xh_to_h(xh))
         return ht
 
+    # the fused path splits the weights of xh_to_h into the columns acting on x and on h,
+    # so the x half can be computed for all timesteps at once outside of the recurrence
+
+    def input_proj(self, x):
+        """ input half of the projection for all timesteps: (b, t, n_embd) -> (b, t, n_embd2) """
+        return F.linear(x, self.xh_to_h.weight[:, :self.n_embd], self.xh_to_h.bias)
+
+    def hidden_weights(self):
+        return self.xh_to_h.weight[:, self.n_embd:].t() # (n_embd2, n_embd2), transposed for addmm
+
+    def forward_fused(self, xp, hprev, w_h):
+        """ same as forward, given the timestep's input_proj xp and the hidden_weights w_h """
+        return F.tanh(torch.addmm(xp, hprev, w_h))
+
 class GRUCell(nn.Module):
     """
     same job as RNN cell, but a bit more complicated recurrence formula
@@ -281,6 +367,7 @@ class GRUCell(nn.Module):
     """
     def __init__(self, config):
         super().__init__()
+        self.n_embd = config.n_embd
         # input, forget, output, gate
         self.xh_to_z = nn.Linear(config.n_embd + config.n_embd2, config.n_embd2)
         self.xh_to_r = nn.Linear(config.n_embd + config.n_embd2, config.n_embd2)
@@ -300,6 +387,34 @@ class GRUCell(nn.Module):
         ht = (1 - z) * hprev + z * hbar
         return ht
 
+    # the fused path splits the weights of each gate into the columns acting on x and on h,
+    # so the x halves of all three gates are one matmul for all timesteps outside of the
+    # recurrence, and inside it the r and z gates share a single matmul with hprev
+
+    def input_proj(self, x):
+        """ input halves of the r, z, hbar projections for all timesteps: (b, t, n_embd) -> (b, t, 3 * n_embd2) """
+        n = self.n_embd
+        w = torch.cat([self.xh_to_r.weight[:, :n], self.xh_to_z.weight[:, :n], self.xh_to_hbar.weight[:, :n]])
+        b = torch.cat([self.xh_to_r.bias, self.xh_to_z.bias, self.xh_to_hbar.bias])
+        return F.linear(x, w, b)
+
+    def hidden_weights(self):
+        n = self.n_embd
+        w_rz = torch.cat([self.xh_to_r.weight[:, n:], self.xh_to_z.weight[:, n:]])
+        return w_rz.t(), self.xh_to_hbar.weight[:, n:].t() # transposed for addmm
+
+    def forward_fused(self, xp, hprev, w_h):
+        """ same as forward, given the timestep's input_proj xp and the hidden_weights w_h """
+        w_rz, w_hbar = w_h
+        xrz, xhbar = xp.split([w_rz.size(1), w_hbar.size(1)], dim=1)
+        # both gates in one matmul with the hidden state and one sigmoid
+        r, z = F.sigmoid(torch.addmm(xrz, hprev, w_rz)).chunk(2, dim=1)
+        hbar = F.tanh(torch.addmm(xhbar, r * hprev, w_hbar))
+        # (1 - z) * hprev + z * hbar. not torch.lerp: under bf16 autocast hbar comes out of addmm
+        # in bf16 while hprev stays fp32, and lerp needs both in one dtype
+        ht = hprev + z * (hbar - hprev)
+        return ht
+
 class RNN(nn.Module):
 
     def __init__(self, config, cell_type):
@@ -313,6 +428,8 @@ class RNN(nn.Module):
         elif cell_type == 'gru':
             self.cell = GRUCell(config)
         self.lm_head = nn.Linear(config.n_embd2, self.vocab_size)
+        assert config.rnn_impl in ('fused', 'cell'), f"unknown RNN implementation {config.rnn_impl}"
+        self.fused = config.rnn_impl == 'fused'
 
     def get_block_size(self):
         return self.block_size
@@ -327,11 +444,21 @@ class RNN(nn.Module):
         # sequentially iterate over the inputs and update the RNN state each tick
         hprev = self.start.expand((b, -1)) # expand out the batch dimension
         hiddens = []
-        for i in range(t):
-            xt = emb[:, i, :] # (b, n_embd)
-            ht = self.cell(xt, hprev) # (b, n_embd2)
-            hprev = ht
-            hiddens.append(ht)
+        if self.fused:
+            # the input projections of all timesteps in one batched matmul up front,
+            # only the matmuls with the hidden state remain inside the loop
+            xproj = self.cell.input_proj(emb).unbind(1) # t tensors of shape (b, k * n_embd2)
+            w_h = self.cell.hidden_weights()
+            for i in range(t):
+                ht = self.cell.forward_fused(xproj[i], hprev, w_h) # (b, n_embd2)
+                hprev = ht
+                hiddens.append(ht)
+        else:
+            for i in range(t):
+                xt = emb[:, i, :] # (b, n_embd)
+                ht = self.cell(xt, hprev) # (b, n_embd2)
+                hprev = ht
+                hiddens.append(ht)
 
         # decode the outputs
         hidden = torch.stack(hiddens, 1) # (b, t, n_embd2)
@@ -344,6 +471,23 @@ class RNN(nn.Module):
 
         return logits, loss
 
+    def step(self, token, hidden=None):
+        """
+        advance the recurrence by a single token, for sampling one token at a time.
+        token is a LongTensor of shape (b,), hidden the (b, n_embd2) state after the
+        previous tokens, or None at the start of the sequence. returns the logits of
+        the next token (b, vocab_size) and the new hidden state.
+        """
+        if hidden is None:
+            hidden = self.start.expand((token.size(0), -1))
+        xt = self.wte(token) # (b, n_embd)
+        if self.fused: # same arithmetic as forward, so sampling with and without step agrees
+            ht = self.cell.forward_fused(self.cell.input_proj(xt), hidden, self.cell.hidden_weights())
+        else:
+            ht = self.cell(xt, hidden) # (b, n_embd2)
+        logits = self.lm_head(ht)
+        return logits, ht
+
 # -----------------------------------------------------------------------------
 # MLP language model
 
@@ -374,16 +518,16 @@ class MLP(nn.Module):
 
     def forward(self, idx, targets=None):
 
-        # gather the word embeddings of the previous 3 words
-        embs = []
-        for k in range(self.block_size):
-            tok_emb = self.wte(idx) # token embeddings of shape (b, t, n_embd)
-            idx = torch.roll(idx, 1, 1)
-            idx[:, 0] = self.vocab_size # special <BLANK> token
-            embs.append(tok_emb)
+        # gather the word embeddings of the previous block_size words in a single lookup:
+        # left-pad with the special <BLANK> token, then the window ending at each position
+        # (reversed, so the current token comes first) holds its context
+        b, t = idx.size()
+        padded = F.pad(idx, (self.block_size, 0), value=self.vocab_size) # (b, block_size + t)
+        ctx = padded.unfold(1, self.block_size, 1)[:, 1:, :].flip(-1) # (b, t, block_size)
+        tok_emb = self.wte(ctx) # (b, t, block_size, n_embd)
 
         # concat all of the embeddings together and pass through an MLP
-        x = torch.cat(embs, -1) # (b, t, n_embd * block_size)
+        x = tok_emb.view(b, t, -1) # (b, t, n_embd * block_size)
         logits = self.mlp(x)
 
         # if we are given some desired targets also calculate the loss
@@ -422,58 +566,433 @@ class Bigram(nn.Module):
 
         return logits, loss
 
+    @torch.no_grad()
+    def fit_counts(self, x, y, smoothing=1.0):
+        """
+        sets the logits to the maximum likelihood solution in one pass over the encoded
+        dataset x, y (as returned by encode_all): the log of the normalized counts of each
+        (previous, next) character pair, with smoothing added to every count
+        """
+        n = self.logits.size(0)
+        mask = y != -1 # the inactive positions after the <STOP> token
+        pairs = x[mask] * n + y[mask]
+        counts = torch.bincount(pairs, minlength=n * n).view(n, n).float() + smoothing
+        self.logits.copy_((counts / counts.sum(1, keepdim=True)).log())
+
+    @torch.no_grad()
+    def sample(self, num, max_new_tokens, generator=None):
+        """
+        draws num sequences following the <START> token with per-row alias tables, much
+        faster than generate for this model. returns a LongTensor (num, max_new_tokens)
+        where every row ends with its <STOP> token 0 (and zeros after it), if it stopped
+        """
+        sampler = AliasSampler(F.softmax(self.logits.float(), dim=-1).cpu())
+        out = torch.zeros(num, max_new_tokens, dtype=torch.long)
+        rows = torch.arange(num) # the sequences that did not stop yet
+        tok = torch.zeros(num, dtype=torch.long) # all start with the <START> token
+        for t in range(max_new_tokens):
+            tok = sampler.draw(tok, generator)
+            out[rows, t] = tok
+            active = tok != 0
+            rows, tok = rows[active], tok[active]
+            if rows.numel() == 0:
+                break
+        return out
+
+class AliasSampler:
+    """
+    draws from n categorical distributions over n tokens, the rows of probs (n, n), with
+    Walker's alias method: every row is split into n equally likely columns, and column j
+    yields token j with probability prob[j], or else its alias[j]. a draw then costs one
+    random column and one coin flip, whatever the size of the vocabulary.
+    """
+
+    def __init__(self, probs):
+        n = probs.size(1)
+        self.prob = torch.ones(probs.shape)
+        self.alias = torch.arange(n).repeat(probs.size(0), 1)
+        # Vose's construction, per row: pair every underfull column with an overfull token
+        for r, row in enumerate((probs.double() * n).tolist()):
+            small = [j for j, p in enumerate(row) if p < 1.0]
+            large = [j for j, p in enumerate(row) if p >= 1.0]
+            while small and large:
+                j, k = small.pop(), large.pop()
+                self.prob[r, j] = row[j]
+                self.alias[r, j] = k
+                row[k] -= 1.0 - row[j]
+                (small if row[k] < 1.0 else large).append(k)
+            # whatever is left over is 1.0 up to rounding, and keeps its own token
+
+    def draw(self, rows, generator=None):
+        """ one token from each of the distributions rows (LongTensor), as a LongTensor of the same shape """
+        j = torch.randint(self.prob.size(1), rows.shape, generator=generator)
+        u = torch.rand(rows.shape, generator=generator)
+        return torch.where(u < self.prob[rows, j], j, self.alias[rows, j])
+
+def create_model(model_type, config):
+    """ instantiates the model of the given type (the --type flag) """
+    if model_type == 'transformer':
+        model = Transformer(config)
+    elif model_type == 'bigram':
+        model = Bigram(config)
+    elif model_type == 'mlp':
+        model = MLP(config)
+    elif model_type == 'rnn':
+        model = RNN(config, cell_type='rnn')
+    elif model_type == 'gru':
+        model = RNN(config, cell_type='gru')
+    elif model_type == 'bow':
+        model = BoW(config)
+    else:
+        raise ValueError(f'model type {model_type} is not recognized')
+    return model
+
+# -----------------------------------------------------------------------------
+# int8 quantization and TorchScript export of a trained model, for CPU inference
+
+def quantize(model):
+    """
+    post-training dynamic int8 quantization of all the nn.Linear layers, in place: the weights
+    are stored in int8 and the activations are quantized on the fly at every matmul. CPU only.
+    """
+    # note: in place rather than on a deepcopy, the copy of a Block would keep calling the
+    # original mlp through its mlpf lambda
+    model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    if getattr(model, 'fused', False):
+        # the fused RNN path slices the fp32 weights of the cell, the cell path calls its quantized layers
+        model.fused = False
+    return model
+
+def export_path(work_dir, quantized=False):
+    return os.path.join(work_dir, 'model-int8.ts.pt' if quantized else 'model.ts.pt')
+
+class LogitsOnly(nn.Module):
+    """ the forward pass of a model without targets, returning just the logits, for tracing """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, idx):
+        logits, _ = self.model(idx)
+        return logits
+
+def export_model(model, path, block_size=None):
+    """
+    traces the model at inputs of exactly block_size positions and saves it as TorchScript.
+    block_size defaults to the model's context length, but that is 1 for the bigram (it only
+    looks at the last token), so pass the dataset's output length to take whole words
+    """
+    block_size = model.get_block_size() if block_size is None else block_size
+    device = next(model.parameters(), torch.empty(0)).device
+    example = torch.zeros(2, block_size, dtype=torch.long, device=device)
+    with torch.no_grad():
+        traced = torch.jit.trace(LogitsOnly(model).eval(), example, check_trace=False)
+    torch.jit.save(traced, path, _extra_files={'block_size': str(block_size)})
+
+class ExportedModel(nn.Module):
+    """
+    a model saved by export_model, loaded without any of the model code. the trace only takes
+    inputs of exactly block_size positions, so shorter ones are padded on the right: all the
+    models here are causal, so the padding leaves the logits of the real positions unchanged
+    (up to the activation scales that an int8 model picks per batch, which it shifts a little)
+    """
+
+    def __init__(self, path, device='cpu'):
+        super().__init__()
+        extra_files = {'block_size': ''}
+        self.module = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+        self.block_size = int(extra_files['block_size'])
+
+    def get_block_size(self):
+        return self.block_size
+
+    def forward(self, idx, targets=None):
+        t = idx.size(1)
+        assert t <= self.block_size, f"cannot forward sequence of length {t}, the export only takes {self.block_size} positions"
+        logits = self.module(F.pad(idx, (0, self.block_size - t)))[:, :t]
+        loss = None
+        if targets is not None:
+            loss = F.cross_entropy(logits.reshape(-1, logits.size(-1)), targets.reshape(-1), ignore_index=-1)
+        return logits, loss
+
 # -----------------------------------------------------------------------------
 # helper functions for evaluating and sampling from the model
 
+def autocast(device, dtype):
+    """ context that runs the model in the given precision, fp32 or bf16 mixed precision """
+    if dtype == 'fp32':
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device.split(':')[0], dtype=torch.bfloat16)
+
+class DecodeState:
+    """
+    the state a model carries from one sampling step to the next. models that support
+    incremental decoding only process the newest tokens at each step: the Transformer
+    keeps a cache of keys/values and the RNN carries its hidden state forward. all
+    other models (and any model once the context is cropped) re-run the full window.
+    """
+
+    def __init__(self, model, use_cache=True):
+        self.model = model
+        self.block_size = model.get_block_size()
+        self.kv_cache = model.init_kv_cache() if use_cache and hasattr(model, 'init_kv_cache') else None
+        self.recurrent = use_cache and hasattr(model, 'step')
+        self.hidden, self.n_seen = None, 0 # recurrent state and the number of tokens it has consumed
+
+    def next_logits(self, idx):
+        """ returns the logits (b, vocab_size) of the token following the sequences idx (b, t) """
+        model = self.model
+        if idx.size(1) > self.block_size:
+            # the context is cropped at block_size from now on, so every position shifts by
+            # one each step and the cached state no longer applies: run the full window
+            self.kv_cache, self.recurrent = None, False
+        if self.kv_cache is not None:
+            # forward only the positions that are not in the cache yet (the whole prefix at first)
+            logits, _ = model(idx[:, len(self.kv_cache):], kv_cache=self.kv_cache)
+            return logits[:, -1, :]
+        if self.recurrent:
+            # advance the hidden state over the tokens it has not seen yet (the whole prefix at first)
+            for i in range(self.n_seen, idx.size(1)):
+                logits, self.hidden = model.step(idx[:, i], self.hidden)
+            self.n_seen = idx.size(1)
+            return logits
+        # if the sequence context is growing too long we must crop it at block_size
+        idx_cond = idx if idx.size(1) <= self.block_size else idx[:, -self.block_size:]
+        # forward the model to get the logits for the index in the sequence
+        logits, _ = model(idx_cond)
+        return logits[:, -1, :]
+
+    def select(self, rows):
+        """ keeps only the given rows (LongTensor of batch indices) of the cached state """
+        if self.kv_cache is not None:
+            self.kv_cache.select(rows)
+        if self.hidden is not None:
+            self.hidden = self.hidden[rows]
+
+def sample_next(logits, temperature=1.0, do_sample=False, top_k=None, top_p=None, disallowed=None):
+    """
+    picks the next token (b, 1) given the logits (b, vocab_size) of the final step.
+    temperature, top_k and top_p are either one value for all rows or a tensor (b,) of
+    per-row values (top_k >= vocab_size or top_p >= 1 leave a row unfiltered).
+    disallowed is a bool mask (vocab_size,) or (b, vocab_size) of tokens never to pick.
+    """
+    # scale by desired temperature (in fp32, also when the model ran in lower precision)
+    if isinstance(temperature, torch.Tensor):
+        temperature = temperature.unsqueeze(1)
+    logits = logits.float() / temperature
+    # optionally rule out some of the tokens altogether
+    if disallowed is not None:
+        logits = logits.masked_fill(disallowed, -float('Inf'))
+    # optionally crop the logits to the top k and/or the nucleus of top p probability mass.
+    # both filters keep a prefix of the sorted logits, so one sort serves the whole batch
+    if top_k is not None or top_p is not None:
+        sorted_logits, _ = torch.sort(logits, dim=-1, descending=True)
+        keep = torch.ones_like(sorted_logits, dtype=torch.bool)
+        if top_k is not None:
+            if isinstance(top_k, torch.Tensor):
+                top_k = top_k.unsqueeze(1)
+            keep &= torch.arange(logits.size(-1), device=logits.device) < top_k
+        if top_p is not None:
+            if isinstance(top_p, torch.Tensor):
+                top_p = top_p.unsqueeze(1)
+            # probabilities after the top-k crop; a token stays in while the more likely
+            # ones hold less than top_p of the mass
+            probs = F.softmax(sorted_logits.masked_fill(~keep, -float('Inf')), dim=-1)
+            keep &= probs.cumsum(dim=-1) - probs < top_p
+        # the most likely token always stays, also for top_k < 1 or top_p <= 0
+        keep[:, 0] = True
+        # everything below the smallest kept logit goes (ties with it stay)
+        threshold = sorted_logits.gather(1, keep.sum(dim=-1, keepdim=True) - 1)
+        logits = logits.masked_fill(logits < threshold, -float('Inf'))
+    # apply softmax to convert logits to (normalized) probabilities
+    probs = F.softmax(logits, dim=-1)
+    # either sample from the distribution or take the most likely element
+    if do_sample:
+        idx_next = torch.multinomial(probs, num_samples=1)
+    else:
+        _, idx_next = torch.topk(probs, k=1, dim=-1)
+    return idx_next
+
+def force_prefix(idx_next, prefix, lengths, t):
+    """ replaces the picked tokens (b, 1) at position t by the prefix tokens of the rows whose prefix is longer than t """
+    if lengths is None or t >= prefix.size(1):
+        return idx_next
+    return torch.where((lengths > t).unsqueeze(1), prefix[:, t:t+1], idx_next)
+
 @torch.no_grad()
-def generate(model, idx, max_new_tokens, temperature=1.0, do_sample=False, top_k=None):
+def generate(model, idx, max_new_tokens, temperature=1.0, do_sample=False, top_k=None, use_cache=True,
+             top_p=None, disallowed=None, lengths=None):
     """
     Take a conditioning sequence of indices idx (LongTensor of shape (b,t)) and complete
     the sequence max_new_tokens times, feeding the predictions back into the model each time.
     Most likely you'll want to make sure to be in model.eval() mode of operation for this.
+    With use_cache, models that support incremental decoding only process the newest
+    token at each step (see DecodeState). The output is the same as without the cache.
+    The rows of idx can hold prefixes of different lengths (LongTensor (b,), padded to t):
+    generation starts after the shortest one and the others are forced token by token
+    until their own prefix is used up, so all rows end at min(lengths) + max_new_tokens.
+    See sample_next for temperature, top_k, top_p and disallowed.
     """
-    block_size = model.get_block_size()
+    prefix = idx
+    if lengths is not None:
+        idx = idx[:, :int(lengths.min())]
+    state = DecodeState(model, use_cache)
     for _ in range(max_new_tokens):
-        # if the sequence context is growing too long we must crop it at block_size
-        idx_cond = idx if idx.size(1) <= block_size else idx[:, -block_size:]
-        # forward the model to get the logits for the index in the sequence
-        logits, _ = model(idx_cond)
-        # pluck the logits at the final step and scale by desired temperature
-        logits = logits[:, -1, :] / temperature
-        # optionally crop the logits to only the top k options
-        if top_k is not None:
-            v, _ = torch.topk(logits, top_k)
-            logits[logits < v[:, [-1]]] = -float('Inf')
-        # apply softmax to convert logits to (normalized) probabilities
-        probs = F.softmax(logits, dim=-1)
-        # either sample from the distribution or take the most likely element
-        if do_sample:
-            idx_next = torch.multinomial(probs, num_samples=1)
-        else:
-            _, idx_next = torch.topk(probs, k=1, dim=-1)
+        logits = state.next_logits(idx)
+        idx_next = sample_next(logits, temperature, do_sample, top_k, top_p, disallowed)
+        idx_next = force_prefix(idx_next, prefix, lengths, idx.size(1))
         # append sampled index to the running sequence and continue
         idx = torch.cat((idx, idx_next), dim=1)
 
     return idx
 
-def print_samples(num=10):
-    """ samples from the model and pretty prints the decoded samples """
+@torch.no_grad()
+def generate_until_stop(model, idx, max_new_tokens, temperature=1.0, do_sample=False, top_k=None, use_cache=True,
+                        top_p=None, disallowed=None, lengths=None, stop_token=0):
+    """
+    Like generate, but every row finishes as soon as it emits stop_token: finished rows are
+    dropped from the batch (and from the cached state), and generation ends once all rows
+    are done, so the work scales with the actual lengths rather than max_new_tokens.
+    Returns a list of b LongTensors of varying length, each the conditioning sequence
+    followed by the generated tokens, excluding the stop token.
+    """
+    out = [None] * idx.size(0)
+    rows = torch.arange(idx.size(0), device=idx.device) # original row of each active sequence
+    prefix = idx
+    if lengths is not None:
+        idx = idx[:, :int(lengths.min())]
+    # the per-row sampling parameters, they follow their rows as the batch shrinks
+    params = dict(temperature=temperature, top_k=top_k, top_p=top_p, disallowed=disallowed)
+    per_row = [k for k, v in params.items() if isinstance(v, torch.Tensor) and (k != 'disallowed' or v.dim() == 2)]
+    state = DecodeState(model, use_cache)
+    for _ in range(max_new_tokens):
+        logits = state.next_logits(idx)
+        idx_next = sample_next(logits, do_sample=do_sample, **params)
+        idx_next = force_prefix(idx_next, prefix, lengths, idx.size(1))
+        done = idx_next[:, 0] == stop_token
+        if done.any():
+            # retire the finished rows and compact the batch down to the active ones
+            for r, seq in zip(rows[done].tolist(), idx[done]):
+                out[r] = seq
+            keep = (~done).nonzero().squeeze(1)
+            idx, idx_next, rows = idx[keep], idx_next[keep], rows[keep]
+            if lengths is not None:
+                prefix, lengths = prefix[keep], lengths[keep]
+            for k in per_row:
+                params[k] = params[k][keep]
+            state.select(keep)
+            if idx.size(0) == 0:
+                break
+        idx = torch.cat((idx, idx_next), dim=1)
+
+    # rows that did not stop within max_new_tokens
+    for r, seq in zip(rows.tolist(), idx):
+        out[r] = seq
+    return out
+
+class PhaseTimer:
+    """
+    wall time of the phases of a training step (data loading, host-to-device copy, forward,
+    backward, optimizer step), accumulated over the steps until read out. every phase is also
+    a record_function range, so it shows up by name in a profiler trace. on CUDA the device is
+    synchronized at the end of each phase, else we would only time the kernel launches.
+    """
+
+    def __init__(self, device, enabled=True):
+        self.enabled = enabled
+        self.sync = device.startswith('cuda')
+        self.totals = {}
+        self.steps = 0
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        with torch.profiler.record_function(name):
+            t0 = time.time()
+            yield
+            if self.sync:
+                torch.cuda.synchronize()
+        self.totals[name] = self.totals.get(name, 0.0) + time.time() - t0
+
+    def step(self):
+        self.steps += 1
+
+    def read(self):
+        """ returns the mean milliseconds per step of each phase since the last read """
+        ms = {name: total / max(self.steps, 1) * 1000 for name, total in self.totals.items()}
+        self.totals, self.steps = {}, 0
+        return ms
+
+class Profiler:
+    """
+    captures a torch.profiler trace of the training steps [start, start + num_steps), writes
+    it as a Chrome trace (chrome://tracing or ui.perfetto.dev) into work_dir and prints the
+    ops that took the most time
+    """
+
+    def __init__(self, work_dir, device, start, num_steps, first_step=0):
+        self.path = os.path.join(work_dir, f'trace-step{start}.json')
+        self.stop_step = start + num_steps
+        skip = max(start - first_step, 0)
+        warmup = min(skip, 1) # one step to warm up the profiler itself, if there is one before the window
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if device.startswith('cuda'):
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.prof = torch.profiler.profile(
+            activities=activities, record_shapes=True, on_trace_ready=self.trace_ready,
+            schedule=torch.profiler.schedule(wait=skip - warmup, warmup=warmup, active=num_steps, repeat=1))
+        self.prof.start()
+
+    def trace_ready(self, prof):
+        prof.export_chrome_trace(self.path)
+        sort_by = 'self_cuda_time_total' if torch.profiler.ProfilerActivity.CUDA in prof.activities else 'self_cpu_time_total'
+        print(prof.key_averages().table(sort_by=sort_by, row_limit=15))
+        print(f"wrote the profiler trace to {self.path}")
+
+    def step(self, step):
+        """ call at the end of every training step, returns False once the window is done """
+        self.prof.step()
+        if step + 1 >= self.stop_step:
+            self.prof.stop()
+            return False
+        return True
+
+def print_samples(num=10, model=None):
+    """ samples from the model (by default the one being trained) and pretty prints the decoded samples """
+    model = raw_model if model is None else model
     X_init = torch.zeros(num, 1, dtype=torch.long).to(args.device)
     top_k = args.top_k if args.top_k != -1 else None
+    top_p = args.top_p if args.top_p < 1 else None
     steps = train_dataset.get_output_length() - 1 # -1 because we already start with <START> token (index 0)
-    X_samp = generate(model, X_init, steps, top_k=top_k, do_sample=True).to('cpu')
+    if isinstance(model, Bigram) and top_k is None and top_p is None:
+        # the bigram draws from its alias tables directly
+        words = train_dataset.decode_many(model.sample(num, steps))
+    else:
+        # note: sample with the uncompiled model, its input shapes change at every step
+        with autocast(args.device, args.dtype):
+            X_samp = generate_until_stop(model, X_init, steps, top_k=top_k, top_p=top_p, do_sample=True)
+        # get the sampled integers as python lists, generation already stopped before the <STOP> token
+        # note: we need to crop out the first <START> token
+        words = [train_dataset.decode(seq[1:].tolist()) for seq in X_samp]
+    if len(train_dataset) == 0:
+        # the training words are unknown (a sidecar without the corpus), so is which samples are new
+        print('-'*80)
+        print(f"{len(words)} samples (without the training set novelty isn't reported, pass -i to get it):")
+        for word in words:
+            print(word)
+        print('-'*80)
+        return
+    # separately track samples that we have and have not seen before
+    in_train = train_dataset.contains_many(words)
+    in_test = test_dataset.contains_many(words)
     train_samples, test_samples, new_samples = [], [], []
-    for i in range(X_samp.size(0)):
-        # get the i'th row of sampled integers, as python list
-        row = X_samp[i, 1:].tolist() # note: we need to crop out the first <START> token
-        # token 0 is the <STOP> token, so we crop the output sequence at that point
-        crop_index = row.index(0) if 0 in row else len(row)
-        row = row[:crop_index]
-        word_samp = train_dataset.decode(row)
-        # separately track samples that we have and have not seen before
-        if train_dataset.contains(word_samp):
+    for word_samp, tr, te in zip(words, in_train, in_test):
+        if tr:
             train_samples.append(word_samp)
-        elif test_dataset.contains(word_samp):
+        elif te:
             test_samples.append(word_samp)
         else:
             new_samples.append(word_samp)
@@ -482,8 +1001,23 @@ def print_samples(num=10):
         print(f"{len(lst)} samples that are {desc}:")
         for word in lst:
             print(word)
+    print(f"novel sample rate: {len(new_samples)/len(words):.2%} of {len(words)} samples")
     print('-'*80)
 
+def get_lr(step, learning_rate, warmup_steps=0, batch_scale=1, lr_scaling='none'):
+    """
+    learning rate of an optimization step: the base learning_rate (tuned for one micro batch)
+    scaled up for an effective batch batch_scale times larger, linearly warmed up over the
+    first warmup_steps steps so that large scaled rates do not destabilize the early steps
+    """
+    if lr_scaling == 'linear':
+        learning_rate *= batch_scale
+    elif lr_scaling == 'sqrt':
+        learning_rate *= math.sqrt(batch_scale)
+    if step < warmup_steps:
+        learning_rate *= (step + 1) / warmup_steps
+    return learning_rate
+
 @torch.inference_mode()
 def evaluate(model, dataset, batch_size=50, max_batches=None):
     model.eval()
@@ -492,7 +1026,8 @@ def evaluate(model, dataset, batch_size=50, max_batches=None):
     for i, batch in enumerate(loader):
         batch = [t.to(args.device) for t in batch]
         X, Y = batch
-        logits, loss = model(X, Y)
+        with autocast(args.device, args.dtype):
+            logits, loss = model(X, Y)
         losses.append(loss.item())
         if max_batches is not None and i >= max_batches:
             break
@@ -500,6 +1035,186 @@ def evaluate(model, dataset, batch_size=50, max_batches=None):
     model.train() # reset model back to training mode
     return mean_loss
 
+@torch.inference_mode()
+def evaluate_full(model, loader):
+    """
+    streams the whole split of an EvalLoader through the model and returns the exact mean
+    loss per (unmasked) target token, together with the evaluation throughput in tokens/sec
+    """
+    model.eval()
+    t0 = time.time()
+    loss_sum, num_tokens = 0.0, 0
+    for X, Y in loader:
+        with autocast(loader.device, args.dtype):
+            logits, _ = model(X)
+        # sum (rather than average) per batch, batches differ in their number of masked positions
+        loss_sum += F.cross_entropy(logits.view(-1, logits.size(-1)).float(), Y.view(-1), ignore_index=-1, reduction='sum')
+        num_tokens += (Y != -1).sum()
+    mean_loss = (loss_sum / num_tokens).item() # note: the .item() also waits for the device to finish
+    t1 = time.time()
+    model.train() # reset model back to training mode
+    return mean_loss, num_tokens.item() / (t1 - t0)
+
+class EvalLoader:
+    """
+    fixed-order batches over a whole dataset for evaluate_full. the encoded split is held as
+    two tensors (on the device) that are sliced into batches, so the loader is built once and
+    reused by every evaluation instead of creating a DataLoader each time
+    """
+
+    def __init__(self, dataset, batch_size, device='cpu'):
+        X, Y = dataset.encode_all()
+        self.X = X.to(device)
+        self.Y = Y.to(device)
+        self.batch_size = batch_size
+        self.device = device
+
+    def __iter__(self):
+        for i in range(0, self.X.size(0), self.batch_size):
+            yield self.X[i:i+self.batch_size], self.Y[i:i+self.batch_size]
+
+# -----------------------------------------------------------------------------
+# helper functions for periodic evaluation and checkpointing during training
+
+@contextlib.contextmanager
+def atomic_write(path):
+    """
+    yields a temporary path next to path that is renamed over it once the block succeeds, so
+    path never holds a partial file. the temporary name is unique to the process and thread,
+    so concurrent writers of the same path don't write into (or rename away) each other's file
+    """
+    tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        yield tmp
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def save_checkpoint(obj, path):
+    """ torch.save via a temporary file and a rename, so path never holds a partial checkpoint """
+    with atomic_write(path) as tmp:
+        torch.save(obj, tmp)
+
+def meta_path(work_dir):
+    return os.path.join(work_dir, 'meta.json')
+
+def save_meta(work_dir, model_type, config, train_dataset, test_dataset):
+    """
+    writes the small sidecar of the model in work_dir: its type and config, the vocabulary
+    and the test split, everything --sample-only and --eval-only need besides the weights
+    """
+    meta = dict(type=model_type, config=asdict(config), chars=''.join(train_dataset.chars),
+                max_word_length=train_dataset.max_word_length, test_words=test_dataset.words)
+    path = meta_path(work_dir)
+    with atomic_write(path) as tmp, open(tmp, 'w') as f:
+        json.dump(meta, f)
+
+def load_meta(work_dir):
+    """ the sidecar written by save_meta, or None for a work_dir from before it existed """
+    path = meta_path(work_dir)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def datasets_from_meta(meta, input_file=None):
+    """
+    the train/test datasets of a sidecar, without re-reading and splitting the corpus. the
+    training words are not in the sidecar: they are read from input_file if it is given
+    (only to tell the samples that are in the training set apart), else left empty, in which
+    case print_samples doesn't split the samples into in train/in test/new
+    """
+    chars, max_word_length, test_words = list(meta['chars']), meta['max_word_length'], meta['test_words']
+    train_words = []
+    if input_file is not None:
+        if os.path.exists(input_file):
+            test_set = set(test_words)
+            train_words = [w for w in read_words(input_file) if w not in test_set]
+        else:
+            print(f"warning: {input_file} not found, samples can't be told apart from the training set")
+    return CharDataset(train_words, chars, max_word_length), CharDataset(test_words, chars, max_word_length)
+
+def snapshot(obj):
+    """ copies the tensors of a (nested dict/list) state, so that training can go on modifying the originals """
+    if torch.is_tensor(obj):
+        return obj.detach().clone()
+    if isinstance(obj, dict):
+        return {k: snapshot(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+def latest_checkpoint(work_dir):
+    """ path of the most recent rolling checkpoint in the work dir, or None """
+    paths = sorted(glob.glob(os.path.join(work_dir, 'ckpt-*.pt')))
+    return paths[-1] if paths else None
+
+def save_training_state(ckpt, step):
+    """ writes a rolling checkpoint of the full training state, keeping the last --keep-checkpoints of them """
+    ckpt['best_loss'] = best_loss # note: read now, i.e. after any evaluation that was queued before
+    save_checkpoint(ckpt, os.path.join(args.work_dir, f'ckpt-{step:07d}.pt'))
+    for path in sorted(glob.glob(os.path.join(args.work_dir, 'ckpt-*.pt')))[:-args.keep_checkpoints]:
+        os.remove(path)
+
+def eval_and_save(model, state_dict, step):
+    """ evaluates the model, logs the losses and saves state_dict to model.pt if the test loss improved """
+    global best_loss
+    if args.eval_full:
+        train_loss, train_tps = evaluate_full(model, train_eval_loader)
+        test_loss, test_tps = evaluate_full(model, test_eval_loader)
+        print(f"step {step} evaluated the full splits at {train_tps:.0f} (train) and {test_tps:.0f} (test) tok/s")
+    else:
+        train_loss = evaluate(model, train_dataset, batch_size=100, max_batches=10)
+        test_loss  = evaluate(model, test_dataset,  batch_size=100, max_batches=10)
+    writer.add_scalar("Loss/train", train_loss, step)
+    writer.add_scalar("Loss/test", test_loss, step)
+    writer.flush()
+    print(f"step {step} train loss: {train_loss} test loss: {test_loss}")
+    # save the model to disk if it has improved
+    if best_loss is None or test_loss < best_loss:
+        out_path = os.path.join(args.work_dir, "model.pt")
+        print(f"test loss {test_loss} is the best so far, saving model to {out_path}")
+        save_checkpoint(state_dict, out_path)
+        best_loss = test_loss
+
+def run_periodic(model, state_dict, step, do_eval, do_sample):
+    """ the periodic evaluation/checkpointing and sampling of a training step """
+    if do_eval:
+        eval_and_save(model, state_dict, step)
+    if do_sample:
+        print_samples(num=10, model=model)
+
+class BackgroundWorker:
+    """
+    runs jobs like run_periodic in a background thread, on a snapshot of the weights loaded
+    into a separate copy of the model, so that the training loop only pays for copying the
+    state dict. at most one job is in flight: submitting waits for the previous one.
+    """
+
+    def __init__(self, model):
+        self.model = model # the copy the snapshots are loaded into
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.future = None
+
+    def submit(self, fn, state_dict):
+        """ runs fn(model, state_dict) with a snapshot of state_dict loaded into the model copy """
+        def job(state_dict):
+            self.model.load_state_dict(state_dict)
+            fn(self.model, state_dict)
+        self.run(job, snapshot(state_dict))
+
+    def run(self, fn, *args):
+        """ runs fn(*args) after the previous job, the arguments must not be modified meanwhile """
+        self.wait()
+        self.future = self.executor.submit(fn, *args)
+
+    def wait(self):
+        """ blocks until the current job is done, re-raising its exception if it failed """
+        if self.future is not None:
+            self.future.result()
+            self.future = None
+
 # -----------------------------------------------------------------------------
 # helper functions for creating the training and test Datasets that emit words
 
@@ -507,6 +1222,7 @@ class CharDataset(Dataset):
 
     def __init__(self, words, chars, max_word_length):
         self.words = words
+        self.word_set = set(words) # hashed index for O(1) membership tests
         self.chars = chars
         self.max_word_length = max_word_length
         self.stoi = {ch:i+1 for i,ch in enumerate(chars)}
@@ -516,7 +1232,12 @@ class CharDataset(Dataset):
         return len(self.words)
 
     def contains(self, word):
-        return word in self.words
+        return word in self.word_set
+
+    def contains_many(self, words):
+        """ membership of each of the given words, as a list of bools """
+        word_set = self.word_set
+        return [w in word_set for w in words]
 
     def get_vocab_size(self):
         return len(self.chars) + 1 # all the possible characters and special 0 token
@@ -532,6 +1253,17 @@ class CharDataset(Dataset):
         word = ''.join(self.itos[i] for i in ix)
         return word
 
+    def decode_many(self, ix):
+        """ decodes the rows of ix (LongTensor (b, t), each zero-padded after its word) in one go """
+        lengths = (ix != 0).sum(1).tolist()
+        codepoints = torch.tensor([0] + [ord(ch) for ch in self.chars])
+        text = ''.join(map(chr, codepoints[ix[ix != 0]].tolist())) # all the words back to back
+        words, start = [], 0
+        for n in lengths:
+            words.append(text[start:start+n])
+            start += n
+        return words
+
     def __getitem__(self, idx):
         word = self.words[idx]
         ix = self.encode(word)
@@ -542,16 +1274,103 @@ class CharDataset(Dataset):
         y[len(ix)+1:] = -1 # index -1 will mask the loss at the inactive locations
         return x, y
 
-def create_datasets(input_file):
+    def encode_all(self):
+        """ the (x, y) pairs of all the words stacked into two tensors of shape (N, max_word_length + 1) """
+        n, t = len(self.words), self.max_word_length
+        x = torch.zeros(n, t + 1, dtype=torch.long)
+        y = torch.full_like(x, -1) # index -1 will mask the loss at the inactive locations
+        if n == 0:
+            return x, y
+        # encode all the characters at once: their code points (as utf-32) index a lookup table
+        text = ''.join(self.words)
+        codes = torch.frombuffer(bytearray(text.encode('utf-32-le')), dtype=torch.int32).long()
+        lut = torch.full((max(codes.max().item(), *map(ord, self.chars)) + 1,), -1, dtype=torch.long)
+        lut[torch.tensor([ord(ch) for ch in self.stoi])] = torch.tensor(list(self.stoi.values()))
+        ix = lut[codes]
+        if (ix < 0).any():
+            raise KeyError(text[(ix < 0).nonzero()[0].item()]) # a character outside the vocabulary, as in encode
+        # and scatter them into the rows: the mask is True at the characters of each word, in order
+        lengths = torch.tensor([len(w) for w in self.words], dtype=torch.long)
+        mask = torch.arange(t) < lengths.unsqueeze(1)
+        x[:, 1:][mask] = ix
+        y[:, :t][mask] = ix
+        y[torch.arange(n), lengths] = 0 # the <STOP> token
+        return x, y
 
-    # preprocessing of the input text file
+class MemmapCharDataset(CharDataset):
+    """
+    a CharDataset over the pre-encoded words of a preprocessed input file (see preprocess).
+    x and y are the memory-mapped arrays of the whole file and rows lists the words of this
+    split, so indexing returns zero-copy views instead of encoding the word every time.
+    """
+
+    def __init__(self, words, chars, max_word_length, x, y, rows):
+        super().__init__([words[i] for i in rows], chars, max_word_length)
+        self.x = x
+        self.y = y
+        self.rows = rows
+
+    def __getitem__(self, idx):
+        row = self.rows[idx]
+        return self.x[row], self.y[row]
+
+    def encode_all(self):
+        rows = torch.tensor(self.rows, dtype=torch.long)
+        return self.x[rows], self.y[rows]
+
+def read_words(input_file):
+    """ reads the input text file into a list of words, one per line """
     with open(input_file, 'r') as f:
         data = f.read()
     words = data.splitlines()
     words = [w.strip() for w in words] # get rid of any leading or trailing white space
     words = [w for w in words if w] # get rid of any empty strings
+    return words
+
+def pretokenized_path(input_file):
+    return input_file + '.tokens.pt'
+
+def preprocess(input_file):
+    """
+    one-time preprocessing of the input text file: reads and encodes all the words and
+    writes them together with the padded x/y arrays to a binary file next to the input,
+    which later runs (and their data workers) memory-map instead of re-tokenizing.
+    """
+    words = read_words(input_file)
     chars = sorted(list(set(''.join(words)))) # all the possible characters
     max_word_length = max(len(w) for w in words)
+    x, y = CharDataset(words, chars, max_word_length).encode_all()
+    st = os.stat(input_file)
+    data = dict(words='\n'.join(words), # one string unpickles much faster than a list of them
+                chars=''.join(chars), max_word_length=max_word_length, x=x, y=y,
+                source=[st.st_size, st.st_mtime_ns]) # to detect a changed input file
+    out_path = pretokenized_path(input_file)
+    with atomic_write(out_path) as tmp: # so a concurrent reader never sees a partial file
+        torch.save(data, tmp)
+    print(f"wrote the pre-tokenized dataset to {out_path}")
+    return out_path
+
+def load_pretokenized(input_file):
+    """ memory-maps the preprocessed input file, (re)building it if missing or out of date """
+    path = pretokenized_path(input_file)
+    st = os.stat(input_file)
+    if os.path.exists(path):
+        data = torch.load(path, mmap=True)
+        if data['source'] == [st.st_size, st.st_mtime_ns]:
+            return data
+    preprocess(input_file)
+    return torch.load(path, mmap=True)
+
+def create_datasets(input_file, pretokenized=False):
+
+    # preprocessing of the input text file
+    if pretokenized:
+        data = load_pretokenized(input_file)
+        words, chars, max_word_length = data['words'].split('\n'), list(data['chars']), data['max_word_length']
+    else:
+        words = read_words(input_file)
+        chars = sorted(list(set(''.join(words)))) # all the possible characters
+        max_word_length = max(len(w) for w in words)
     print(f"number of examples in the dataset: {len(words)}")
     print(f"max word length: {max_word_length}")
     print(f"number of unique characters in the vocabulary: {len(chars)}")
@@ -561,13 +1380,16 @@ def create_datasets(input_file):
     # partition the input data into a training and the test set
     test_set_size = min(1000, int(len(words) * 0.1)) # 10% of the training set, or up to 1000 examples
     rp = torch.randperm(len(words)).tolist()
-    train_words = [words[i] for i in rp[:-test_set_size]]
-    test_words = [words[i] for i in rp[-test_set_size:]]
-    print(f"split up the dataset into {len(train_words)} training examples and {len(test_words)} test examples")
+    train_rows, test_rows = rp[:-test_set_size], rp[-test_set_size:]
+    print(f"split up the dataset into {len(train_rows)} training examples and {len(test_rows)} test examples")
 
     # wrap in dataset objects
-    train_dataset = CharDataset(train_words, chars, max_word_length)
-    test_dataset = CharDataset(test_words, chars, max_word_length)
+    if pretokenized:
+        train_dataset = MemmapCharDataset(words, chars, max_word_length, data['x'], data['y'], train_rows)
+        test_dataset = MemmapCharDataset(words, chars, max_word_length, data['x'], data['y'], test_rows)
+    else:
+        train_dataset = CharDataset([words[i] for i in train_rows], chars, max_word_length)
+        test_dataset = CharDataset([words[i] for i in test_rows], chars, max_word_length)
 
     return train_dataset, test_dataset
 
@@ -577,112 +1399,393 @@ class InfiniteDataLoader:
     a better way in PyTorch to just create an infinite dataloader?
     """
 
-    def __init__(self, dataset, **kwargs):
-        train_sampler = torch.utils.data.RandomSampler(dataset, replacement=True, num_samples=int(1e10))
-        self.train_loader = DataLoader(dataset, sampler=train_sampler, **kwargs)
+    def __init__(self, dataset, batch_size, seed=None, rank=0, world_size=1, **kwargs):
+        if world_size > 1:
+            # in distributed training every rank samples from its own disjoint shard of the dataset
+            dataset = torch.utils.data.Subset(dataset, range(rank, len(dataset), world_size))
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.kwargs = kwargs
+        # every rank gets its own random stream
+        self.seed = (seed if seed is not None else torch.randint(2**31, (1,)).item()) + rank
+        self.batches = 0 # number of batches handed out so far, the stream resumes from there
+        self._start()
+
+    def _start(self):
+        batch_sampler = RandomBatchSampler(len(self.dataset), self.batch_size, self.seed, start=self.batches)
+        self.train_loader = DataLoader(self.dataset, batch_sampler=batch_sampler, **self.kwargs)
         self.data_iter = iter(self.train_loader)
 
     def next(self):
-        try:
-            batch = next(self.data_iter)
-        except StopIteration: # this will technically only happen after 1e10 samples... (i.e. basically never)
-            self.data_iter = iter(self.train_loader)
-            batch = next(self.data_iter)
+        batch = next(self.data_iter) # the batch sampler never runs out
+        self.batches += 1
         return batch
 
+    def state_dict(self):
+        return {'seed': self.seed, 'batches': self.batches}
+
+    def load_state_dict(self, state):
+        self.seed, self.batches = state['seed'], state['batches']
+        self._start()
+
+class RandomBatchSampler(torch.utils.data.Sampler):
+    """
+    infinite stream of batches of random indices (drawn with replacement). batch i only
+    depends on the seed and i, so the stream resumes exactly at any batch even though
+    the DataLoader workers prefetch batches ahead of the training loop.
+    """
+
+    def __init__(self, n, batch_size, seed, start=0):
+        self.n = n
+        self.batch_size = batch_size
+        self.seed = seed
+        self.start = start
+
+    def __iter__(self):
+        g = torch.Generator()
+        i = self.start
+        while True:
+            g.manual_seed(self.seed * 2**32 + i)
+            yield torch.randint(self.n, (self.batch_size,), generator=g).tolist()
+            i += 1
+
+class InMemoryBatchLoader:
+    """
+    a drop-in for InfiniteDataLoader that holds the whole encoded dataset as two tensors
+    (optionally already on the device) and draws each batch with a single random index
+    gather. for our tiny models the per-sample Python overhead of a DataLoader otherwise
+    dominates the step time.
+    """
+
+    def __init__(self, dataset, batch_size, device='cpu', seed=None, rank=0, world_size=1):
+        X, Y = dataset.encode_all()
+        # in distributed training every rank samples from its own disjoint shard
+        self.X = X[rank::world_size].to(device)
+        self.Y = Y[rank::world_size].to(device)
+        self.batch_size = batch_size
+        # a separate generator so the batches only depend on the seed (and rank)
+        self.generator = torch.Generator()
+        self.generator.manual_seed((seed if seed is not None else torch.randint(2**62, (1,)).item()) + rank)
+
+    def next(self):
+        ix = torch.randint(self.X.size(0), (self.batch_size,), generator=self.generator).to(self.X.device)
+        return [self.X[ix], self.Y[ix]]
+
+    def state_dict(self):
+        return {'generator': self.generator.get_state()}
+
+    def load_state_dict(self, state):
+        self.generator.set_state(state['generator'].cpu()) # the checkpoint may have been loaded onto the device
+
+class BucketedBatchLoader(InMemoryBatchLoader):
+    """
+    an InMemoryBatchLoader that draws every batch from a single bucket of words of similar
+    length and trims it to its longest member, instead of padding every batch to the longest
+    word in the dataset. words are still picked uniformly overall: the bucket is chosen with
+    probability proportional to its size.
+    """
+
+    def __init__(self, dataset, batch_size, device='cpu', seed=None, rank=0, world_size=1, bucket_width=4):
+        super().__init__(dataset, batch_size, device, seed, rank, world_size)
+        # the positions that matter per word: the word itself and the <STOP> token
+        lengths = (self.Y != -1).sum(1)
+        # sort the words by length, so that every bucket is a contiguous range
+        order = torch.argsort(lengths)
+        self.X, self.Y, self.lengths = self.X[order], self.Y[order], lengths[order]
+        _, bucket, counts = torch.unique_consecutive((self.lengths.cpu() - 1) // bucket_width,
+                                                     return_inverse=True, return_counts=True)
+        self.bucket = bucket # the bucket of every (sorted) word
+        self.bucket_start = counts.cumsum(0) - counts
+        self.bucket_size = counts
+        # running totals for the padding statistics
+        self.real_tokens = 0
+        self.padded_tokens = 0
+
+    def next(self):
+        # a uniformly random word picks the bucket, then the whole batch comes from that bucket
+        b = self.bucket[torch.randint(self.X.size(0), (1,), generator=self.generator)].item()
+        ix = self.bucket_start[b] + torch.randint(self.bucket_size[b].item(), (self.batch_size,), generator=self.generator)
+        ix = ix.to(self.X.device)
+        lengths = self.lengths[ix]
+        t = lengths.max().item() # trim the batch to its longest member
+        self.real_tokens += lengths.sum().item()
+        self.padded_tokens += self.batch_size * t
+        return [self.X[ix, :t], self.Y[ix, :t]]
+
+    def padding_ratio(self):
+        """ padded tokens per real token over the batches drawn so far (1.0 means no padding) """
+        return self.padded_tokens / max(self.real_tokens, 1)
+
+def padding_ratio(dataset):
+    """ padded tokens per real token when every word is padded to the full output length """
+    real_tokens = sum(len(w) + 1 for w in dataset.words) # the word and its <STOP> token
+    return len(dataset) * dataset.get_output_length() / real_tokens
+
 # -----------------------------------------------------------------------------
 if __name__ == '__main__':
 
     # parse command line args
     parser = argparse.ArgumentParser(description="Make More")
     # system/input/output
-    parser.add_argument('--input-file', '-i', type=str, default='names.txt', help="input file with things one per line")
+    parser.add_argument('--input-file', '-i', type=str, default=None, help="input file with things one per line (default names.txt). --sample-only from a model's sidecar only reads it when given, to tell the new samples apart")
     parser.add_argument('--work-dir', '-o', type=str, default='out', help="output working directory")
-    parser.add_argument('--resume', action='store_true', help="when this flag is used, we will resume optimization from existing model in the workdir")
+    parser.add_argument('--resume', action='store_true', help="when this flag is used, we will resume optimization from the latest checkpoint (or else the existing model) in the workdir")
+    parser.add_argument('--checkpoint-every', type=int, default=500, help="save a rolling checkpoint of the full training state every this many steps (and at the end), 0 to disable")
+    parser.add_argument('--keep-checkpoints', type=int, default=3, help="number of most recent rolling checkpoints to keep")
     parser.add_argument('--sample-only', action='store_true', help="just sample from the model and quit, don't train")
+    parser.add_argument('--eval-only', action='store_true', help="just evaluate the model on the test split and quit, don't train")
+    parser.add_argument('--quantize', action='store_true', help="with --sample-only, --eval-only or --export, quantize the Linear layers of the model to int8 (dynamic quantization, CPU only). this makes the model ~3x smaller on disk but, at these model sizes, slower to sample from than fp32")
+    parser.add_argument('--export', action='store_true', help="export the model in the workdir (int8 with --quantize) to TorchScript, for --use-export, and quit")
+    parser.add_argument('--use-export', action='store_true', help="with --sample-only or --eval-only, run the model exported by --export instead of the model code. for deploying without the model code, not for speed: the fixed-shape trace has no KV cache or RNN state, so sampling is several times slower than eager")
     parser.add_argument('--num-workers', '-n', type=int, default=4, help="number of data workers for both train/test")
+    parser.add_argument('--batch-loader', type=str, default='dataloader', choices=['dataloader', 'memory', 'bucketed'], help="dataloader: torch DataLoader over the dataset, memory: whole dataset as one tensor on the device, one gather per batch, bucketed: like memory but every batch holds words of similar length and is trimmed to the longest")
+    parser.add_argument('--bucket-width', type=int, default=4, help="range of word lengths that share a bucket with --batch-loader bucketed")
+    parser.add_argument('--pretokenize', action='store_true', help="encode the input file once into a memory-mapped binary file next to it and load the datasets from that")
     parser.add_argument('--max-steps', type=int, default=-1, help="max number of optimization steps to run for, or -1 for infinite.")
     parser.add_argument('--device', type=str, default='cpu', help="device to use for compute, examples: cpu|cuda|cuda:2|mps")
     parser.add_argument('--seed', type=int, default=3407, help="seed")
+    parser.add_argument('--async-eval', action='store_true', help="run the periodic evaluation, checkpointing and sampling in a background thread on a snapshot of the weights")
+    parser.add_argument('--eval-full', action='store_true', help="evaluate on the whole train and test splits with the exact per-token loss, instead of 10 random batches")
+    parser.add_argument('--eval-batch-size', type=int, default=1000, help="batch size of --eval-full")
+    parser.add_argument('--compile', action='store_true', help="compile the model with torch.compile for training and evaluation")
+    parser.add_argument('--dtype', type=str, default='fp32', choices=['fp32', 'bf16'], help="precision of the forward passes, bf16 runs them under autocast")
+    parser.add_argument('--timers', action='store_true', help="time the phases of every step (data, h2d copy, forward, backward, optimizer), printed and logged to tensorboard every 10 steps")
+    parser.add_argument('--profile-start', type=int, default=-1, help="capture a torch.profiler trace from this step on, into the workdir as a Chrome trace, -1 to disable")
+    parser.add_argument('--profile-steps', type=int, default=5, help="number of steps in the --profile-start trace")
     # sampling
     parser.add_argument('--top-k', type=int, default=-1, help="top-k for sampling, -1 means no top-k")
+    parser.add_argument('--top-p', type=float, default=1.0, help="top-p (nucleus) for sampling, 1.0 means no top-p")
     # model
     parser.add_argument('--type', type=str, default='transformer', help="model class type to use, bigram|mlp|rnn|gru|bow|transformer")
+    parser.add_argument('--bigram-counts', action='store_true', help="(in a bigram) fit the model by counting the character pairs of the training set in one pass instead of training it, then quit")
+    parser.add_argument('--smoothing', type=float, default=1.0, help="pseudo-count added to every character pair with --bigram-counts")
     parser.add_argument('--n-layer', type=int, default=4, help="number of layers")
     parser.add_argument('--n-head', type=int, default=4, help="number of heads (in a transformer)")
     parser.add_argument('--n-embd', type=int, default=64, help="number of feature channels in the model")
     parser.add_argument('--n-embd2', type=int, default=64, help="number of feature channels elsewhere in the model")
+    parser.add_argument('--rnn-impl', type=str, default='fused', choices=['fused', 'cell'], help="recurrence implementation (in a rnn/gru): fused input projections or one cell call per step")
+    parser.add_argument('--bow-impl', type=str, default='cumsum', choices=['cumsum', 'softmax'], help="causal average implementation (in a bow): prefix sum or masked softmax matrix")
+    parser.add_argument('--attn-impl', type=str, default='sdpa', choices=['sdpa', 'explicit'], help="causal self-attention implementation (in a transformer): fused scaled_dot_product_attention or explicit")
     # optimization
     parser.add_argument('--batch-size', '-b', type=int, default=32, help="batch size during optimization")
     parser.add_argument('--learning-rate', '-l', type=float, default=5e-4, help="learning rate")
     parser.add_argument('--weight-decay', '-w', type=float, default=0.01, help="weight decay")
+    parser.add_argument('--grad-accum-steps', type=int, default=1, help="micro batches of --batch-size whose gradients are accumulated per optimization step")
+    parser.add_argument('--lr-scaling', type=str, default='none', choices=['none', 'linear', 'sqrt'], help="scale the learning rate with the effective batch size relative to --batch-size, i.e. with --grad-accum-steps times the number of processes")
+    parser.add_argument('--warmup-steps', type=int, default=0, help="number of steps of linear learning rate warmup")
     args = parser.parse_args()
+    # with a sidecar, --sample-only only reads the corpus when it is asked for explicitly
+    novelty_file = args.input_file
+    args.input_file = args.input_file or 'names.txt'
+    if args.quantize and not (args.sample_only or args.eval_only or args.export):
+        parser.error("--quantize is for inference, use it with --sample-only, --eval-only or --export")
+    if args.use_export and not (args.sample_only or args.eval_only):
+        parser.error("--use-export only applies to --sample-only and --eval-only")
+    if args.bigram_counts and args.type != 'bigram':
+        parser.error("--bigram-counts only applies to --type bigram")
+    if args.top_k != -1 and args.top_k < 1:
+        parser.error("--top-k must be positive, or -1 for no top-k")
+    if args.top_p <= 0:
+        parser.error("--top-p must be positive, or 1.0 for no top-p")
     print(vars(args))
 
+    # distributed data parallel training when launched with torchrun, e.g. to use all the cores
+    # of a CPU box: torchrun --standalone --nproc_per_node=4 makemore.py --device cpu ...
+    ddp = int(os.environ.get('RANK', -1)) != -1
+    if ddp:
+        ddp_local_rank = int(os.environ['LOCAL_RANK'])
+        if args.device.startswith('cuda'):
+            args.device = f'cuda:{ddp_local_rank}'
+            torch.cuda.set_device(args.device)
+        else:
+            # split the cores of the machine between the processes running on it
+            local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+            torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
+        torch.distributed.init_process_group(backend='nccl' if args.device.startswith('cuda') else 'gloo')
+        ddp_rank = torch.distributed.get_rank()
+        ddp_world_size = torch.distributed.get_world_size()
+    else:
+        ddp_rank, ddp_world_size = 0, 1
+    master_process = ddp_rank == 0 # only this process logs, samples and saves checkpoints
+
     # system inits
-    torch.manual_seed(args.seed)
+    torch.manual_seed(args.seed) # note: the same on all ranks, so models start out (and stay) identical
     torch.cuda.manual_seed_all(args.seed)
     os.makedirs(args.work_dir, exist_ok=True)
-    writer = SummaryWriter(log_dir=args.work_dir)
-
-    # init datasets
-    train_dataset, test_dataset = create_datasets(args.input_file)
-    vocab_size = train_dataset.get_vocab_size()
-    block_size = train_dataset.get_output_length()
-    print(f"dataset determined that: {vocab_size=}, {block_size=}")
-
-    # init model
-    config = ModelConfig(vocab_size=vocab_size, block_size=block_size,
-                       n_layer=args.n_layer, n_head=args.n_head,
-                       n_embd=args.n_embd, n_embd2=args.n_embd2)
-    if args.type == 'transformer':
-        model = Transformer(config)
-    elif args.type == 'bigram':
-        model = Bigram(config)
-    elif args.type == 'mlp':
-        model = MLP(config)
-    elif args.type == 'rnn':
-        model = RNN(config, cell_type='rnn')
-    elif args.type == 'gru':
-        model = RNN(config, cell_type='gru')
-    elif args.type == 'bow':
-        model = BoW(config)
+    inference_only = args.sample_only or args.eval_only or args.export
+    writer = None
+    if master_process and not inference_only:
+        from torch.utils.tensorboard import SummaryWriter # slow to import, and only training logs to it
+        writer = SummaryWriter(log_dir=args.work_dir)
+
+    # the sidecar of a trained model has its config, vocabulary and test split, so inference
+    # starts without going through the corpus (and the model flags need not be repeated)
+    meta = load_meta(args.work_dir) if inference_only else None
+    if meta is not None:
+        args.type = meta['type']
+        config = ModelConfig(**meta['config'])
+        train_dataset, test_dataset = datasets_from_meta(meta, novelty_file if args.sample_only else None)
     else:
-        raise ValueError(f'model type {args.type} is not recognized')
+        # init datasets
+        if ddp and args.pretokenize:
+            # only rank 0 (re)builds the pre-tokenized file, the other ranks wait and then map it
+            if master_process:
+                load_pretokenized(args.input_file)
+            torch.distributed.barrier()
+        train_dataset, test_dataset = create_datasets(args.input_file, pretokenized=args.pretokenize)
+        vocab_size = train_dataset.get_vocab_size()
+        block_size = train_dataset.get_output_length()
+        print(f"dataset determined that: {vocab_size=}, {block_size=}")
+
+        # init model
+        config = ModelConfig(vocab_size=vocab_size, block_size=block_size,
+                           n_layer=args.n_layer, n_head=args.n_head,
+                           n_embd=args.n_embd, n_embd2=args.n_embd2,
+                           attn_impl=args.attn_impl, bow_impl=args.bow_impl,
+                           rnn_impl=args.rnn_impl)
+        if master_process and not inference_only:
+            save_meta(args.work_dir, args.type, config, train_dataset, test_dataset)
+    model = create_model(args.type, config)
     model.to(args.device)
     print(f"model #params: {sum(p.numel() for p in model.parameters())}")
-    if args.resume or args.sample_only: # note: if we sample-only then we also assume we are resuming
+    resume_ckpt = None
+    ckpt_path = latest_checkpoint(args.work_dir) if args.resume and not inference_only else None
+    if ckpt_path is not None:
+        # the full training state: model, optimizer, step, best loss, RNG and data order
+        print(f"resuming from the training state in {ckpt_path}")
+        resume_ckpt = torch.load(ckpt_path, map_location=args.device)
+        if len(resume_ckpt['ranks']) != ddp_world_size:
+            # every rank resumes its own data stream and RNG, so the number of processes must match
+            raise ValueError(f"{ckpt_path} was saved by {len(resume_ckpt['ranks'])} processes, "
+                             f"resume it with as many instead of {ddp_world_size}")
+        model.load_state_dict(resume_ckpt['model'])
+    elif args.resume or inference_only: # note: if we sample-only then we also assume we are resuming
         print("resuming from existing model in the workdir")
-        model.load_state_dict(torch.load(os.path.join(args.work_dir, 'model.pt')))
+        model.load_state_dict(torch.load(os.path.join(args.work_dir, 'model.pt'), map_location=args.device))
+    if args.quantize:
+        print("quantizing the Linear layers to int8...")
+        model = quantize(model)
+    if args.export:
+        path = export_path(args.work_dir, args.quantize)
+        export_model(model, path, config.block_size)
+        print(f"exported the model to {path}")
+        sys.exit()
+    if args.use_export:
+        path = export_path(args.work_dir, args.quantize)
+        print(f"sampling from the exported model in {path}")
+        model = ExportedModel(path, device=args.device)
+    raw_model = model # the plain nn.Module, for sampling and saving checkpoints
     if args.sample_only:
         print_samples(num=50)
         sys.exit()
+    if args.eval_only:
+        test_loss, tokens_per_sec = evaluate_full(model, EvalLoader(test_dataset, args.eval_batch_size, device=args.device))
+        print(f"test loss {test_loss:.4f} | evaluated the test split at {tokens_per_sec:.0f} tok/s")
+        sys.exit()
+    if args.bigram_counts:
+        # the maximum likelihood bigram in closed form, instead of the training loop below
+        t0 = time.time()
+        X, Y = train_dataset.encode_all()
+        t1 = time.time()
+        model.fit_counts(X.to(args.device), Y.to(args.device), smoothing=args.smoothing)
+        t2 = time.time()
+        train_loss, _ = evaluate_full(model, EvalLoader(train_dataset, args.eval_batch_size, device=args.device))
+        test_loss, _ = evaluate_full(model, EvalLoader(test_dataset, args.eval_batch_size, device=args.device))
+        print(f"encoded the training set in {(t1-t0)*1000:.2f}ms, counted the bigrams in {(t2-t1)*1000:.2f}ms | "
+              f"train loss {train_loss:.4f} | test loss {test_loss:.4f}")
+        save_checkpoint(raw_model.state_dict(), os.path.join(args.work_dir, "model.pt"))
+        print_samples(num=50)
+        sys.exit()
+    if args.compile:
+        print("compiling the model...")
+        model = torch.compile(model)
+    eval_model = model # evaluation runs on the master process alone, so outside of DDP
+    if ddp:
+        # note: our buffers are constant causal masks, no need to broadcast them every step
+        model = torch.nn.parallel.DistributedDataParallel(model, broadcast_buffers=False)
 
     # init optimizer
     optimizer = torch.optim.AdamW(model.parameters(), lr=args.learning_rate, weight_decay=args.weight_decay, betas=(0.9, 0.99), eps=1e-8)
 
     # init dataloader
-    batch_loader = InfiniteDataLoader(train_dataset, batch_size=args.batch_size, pin_memory=True, num_workers=args.num_workers)
+    if args.batch_loader == 'memory':
+        batch_loader = InMemoryBatchLoader(train_dataset, batch_size=args.batch_size, device=args.device,
+                                           rank=ddp_rank, world_size=ddp_world_size)
+    elif args.batch_loader == 'bucketed':
+        batch_loader = BucketedBatchLoader(train_dataset, batch_size=args.batch_size, device=args.device,
+                                           rank=ddp_rank, world_size=ddp_world_size, bucket_width=args.bucket_width)
+    else:
+        batch_loader = InfiniteDataLoader(train_dataset, rank=ddp_rank, world_size=ddp_world_size,
+                                          batch_size=args.batch_size, pin_memory=True, num_workers=args.num_workers)
+
+    # persistent loaders over the whole splits for --eval-full
+    if args.eval_full and master_process:
+        train_eval_loader = EvalLoader(train_dataset, args.eval_batch_size, device=args.device)
+        test_eval_loader = EvalLoader(test_dataset, args.eval_batch_size, device=args.device)
+
+    # periodic jobs in the background get their own copy of the model, so training continues
+    worker = None
+    if args.async_eval and master_process:
+        worker = BackgroundWorker(create_model(args.type, config).to(args.device))
 
     # training loop
     best_loss = None
     step = 0
+    if resume_ckpt is not None:
+        optimizer.load_state_dict(resume_ckpt['optimizer'])
+        step, best_loss = resume_ckpt['step'], resume_ckpt['best_loss']
+        rank_state = resume_ckpt['ranks'][ddp_rank]
+        batch_loader.load_state_dict(rank_state['loader'])
+        torch.set_rng_state(rank_state['rng'].cpu())
+        if rank_state['cuda_rng'] is not None:
+            torch.cuda.set_rng_state_all([t.cpu() for t in rank_state['cuda_rng']])
+        del resume_ckpt
+    first_step = step
+    # opt-in instrumentation: per-phase timers and a profiler trace of a window of steps
+    profiler = None
+    if args.profile_start >= 0 and master_process:
+        profiler = Profiler(args.work_dir, args.device, args.profile_start, args.profile_steps, first_step)
+    timer = PhaseTimer(args.device, enabled=args.timers or profiler is not None)
     while True:
 
         t0 = time.time()
 
-        # get the next batch, ship to device, and unpack it to input and target
-        batch = batch_loader.next()
-        batch = [t.to(args.device) for t in batch]
-        X, Y = batch
+        # determine and set the learning rate for this step
+        lr = get_lr(step, args.learning_rate, args.warmup_steps, args.grad_accum_steps * ddp_world_size, args.lr_scaling)
+        for param_group in optimizer.param_groups:
+            param_group['lr'] = lr
 
-        # feed into the model
-        logits, loss = model(X, Y)
-
-        # calculate the gradient, update the weights
+        # accumulate the gradient over grad_accum_steps micro batches
         model.zero_grad(set_to_none=True)
-        loss.backward()
-        optimizer.step()
+        loss_accum = 0.0
+        num_tokens = 0 # targets that are not masked out with -1
+        for micro_step in range(args.grad_accum_steps):
+            # get the next batch, ship to device, and unpack it to input and target
+            with timer.phase('data'):
+                batch = batch_loader.next()
+            with timer.phase('h2d'):
+                batch = [t.to(args.device) for t in batch]
+            X, Y = batch
+
+            # with DDP, only all-reduce the gradients in the backward of the last micro batch
+            last_micro_step = micro_step == args.grad_accum_steps - 1
+            with model.no_sync() if ddp and not last_micro_step else contextlib.nullcontext():
+                # feed into the model
+                with timer.phase('forward'), autocast(args.device, args.dtype):
+                    logits, loss = model(X, Y)
+
+                # calculate the gradient, scaled so that it is the mean over all micro batches
+                with timer.phase('backward'):
+                    loss = loss / args.grad_accum_steps
+                    loss.backward()
+            loss_accum += loss.detach()
+            num_tokens += (Y != -1).sum()
+
+        # update the weights
+        with timer.phase('optimizer'):
+            optimizer.step()
+        loss = loss_accum
+        timer.step()
 
         # wait for all CUDA work on the GPU to finish then calculate iteration time taken
         if args.device.startswith('cuda'):
@@ -690,30 +1793,62 @@ if __name__ == '__main__':
         t1 = time.time()
 
         # logging
-        if step % 10 == 0:
-            print(f"step {step} | loss {loss.item():.4f} | step time {(t1-t0)*1000:.2f}ms")
-
-        # evaluate the model
-        if step > 0 and step % 500 == 0:
-            train_loss = evaluate(model, train_dataset, batch_size=100, max_batches=10)
-            test_loss  = evaluate(model, test_dataset,  batch_size=100, max_batches=10)
-            writer.add_scalar("Loss/train", train_loss, step)
-            writer.add_scalar("Loss/test", test_loss, step)
-            writer.flush()
-            print(f"step {step} train loss: {train_loss} test loss: {test_loss}")
-            # save the model to disk if it has improved
-            if best_loss is None or test_loss < best_loss:
-                out_path = os.path.join(args.work_dir, "model.pt")
-                print(f"test loss {test_loss} is the best so far, saving model to {out_path}")
-                torch.save(model.state_dict(), out_path)
-                best_loss = test_loss
-
-        # sample from the model
-        if step > 0 and step % 200 == 0:
-            print_samples(num=10)
+        if step % 10 == 0 and ddp:
+            torch.distributed.all_reduce(num_tokens) # tokens processed by all the ranks together
+        if step == first_step and master_process:
+            # the first step also pays for warm-up (and compilation with --compile), report it apart
+            print(f"step {step} | loss {loss.item():.4f} | warm-up step time {(t1-t0)*1000:.2f}ms")
+        elif step % 10 == 0 and master_process:
+            print(f"step {step} | loss {loss.item():.4f} | step time {(t1-t0)*1000:.2f}ms | {num_tokens.item()/(t1-t0):.0f} tok/s | lr {lr:.2e}")
+        if step % 10 == 0 and args.timers and master_process:
+            # mean time per step of each phase since the last report
+            phases = timer.read()
+            print("phases: " + " | ".join(f"{name} {ms:.2f}ms" for name, ms in phases.items()))
+            for name, ms in phases.items():
+                writer.add_scalar(f"Time/{name}", ms, step)
+        if step > 0 and step % 500 == 0 and master_process and isinstance(batch_loader, BucketedBatchLoader):
+            print(f"padded/real tokens: {batch_loader.padding_ratio():.2f} with length buckets, "
+                  f"{padding_ratio(train_dataset):.2f} at full length")
+
+        # evaluate the model (and save it if it improved), and sample from the model
+        do_eval = step > 0 and step % 500 == 0 and master_process
+        do_sample = step > 0 and step % 200 == 0 and master_process
+        if worker is not None and (do_eval or do_sample):
+            job = functools.partial(run_periodic, step=step, do_eval=do_eval, do_sample=do_sample)
+            worker.submit(job, raw_model.state_dict())
+        else:
+            if do_eval:
+                eval_and_save(eval_model, raw_model.state_dict(), step)
+            if do_sample:
+                print_samples(num=10)
+
+        if profiler is not None and not profiler.step(step):
+            profiler = None
 
         step += 1
+        done = args.max_steps >= 0 and step >= args.max_steps
+
+        # save a rolling checkpoint of the full training state to resume from
+        if args.checkpoint_every > 0 and (step % args.checkpoint_every == 0 or done):
+            rank_state = dict(loader=batch_loader.state_dict(), rng=torch.get_rng_state(),
+                              cuda_rng=torch.cuda.get_rng_state_all() if args.device.startswith('cuda') else None)
+            rank_states = [rank_state]
+            if ddp: # every rank has its own data stream and RNG
+                rank_states = [None] * ddp_world_size
+                torch.distributed.all_gather_object(rank_states, rank_state)
+            if master_process:
+                ckpt = dict(model=raw_model.state_dict(), optimizer=optimizer.state_dict(), step=step, ranks=rank_states)
+                if worker is not None:
+                    worker.run(save_training_state, snapshot(ckpt), step)
+                else:
+                    save_training_state(ckpt, step)
+
         # termination conditions
-        if args.max_steps >= 0 and step >= args.max_steps:
+        if done:
             break
 
+    if worker is not None:
+        worker.wait() # let the last evaluation and checkpoint finish
+    if ddp:
+        torch.distributed.destroy_process_group()
+
@@ -0,0 +1,300 @@
+"""
+a long-lived local sampling service for a model trained with makemore.py.
+the model is loaded once, and concurrent requests are coalesced into shared
+generate batches: the first waiting request opens a window of --max-wait-ms,
+and everything that arrives within it (up to --max-batch-size samples) is
+sampled together, each row with its own prefix, temperature, top_k, top_p
+and disallowed characters. e.g.:
+
+$ python serve.py -o out --port 8000
+$ curl -s localhost:8000/sample -d '{"num": 5, "temperature": 0.8, "top_k": 10, "top_p": 0.95, "prefix": "ma", "disallow": "xq"}'
+{"samples": ["marista", "marar", "mairah", "makynni", "mariah"]}
+$ curl -s localhost:8000/stats
+"""
+
+import os
+import json
+import time
+import threading
+import argparse
+import collections
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import torch
+
+from makemore import ModelConfig, create_model, create_datasets, load_meta, datasets_from_meta, autocast, generate_until_stop
+
+# -----------------------------------------------------------------------------
+
+class SampleRequest:
+    """ one client request for num samples, completed by the batcher thread """
+
+    def __init__(self, num, temperature, top_k, top_p, prefix, disallowed):
+        self.num = num
+        self.temperature = temperature
+        self.top_k = top_k # None for no top-k
+        self.top_p = top_p # None for no top-p
+        self.prefix = prefix # LongTensor of the encoded prefix characters
+        self.disallowed = disallowed # LongTensor of the encoded disallowed characters
+        self.t_arrival = time.time()
+        self.done = threading.Event()
+        self.samples = None
+        self.error = None
+
+class Stats:
+    """ latency and throughput counters of the service """
+
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.t_start = time.time()
+        self.requests = 0
+        self.samples = 0
+        self.batches = 0 # number of generate calls
+        self.busy_time = 0.0 # time spent inside generate
+        self.latencies = collections.deque(maxlen=window) # of the most recent requests
+        self.queue_waits = collections.deque(maxlen=window)
+
+    def record_batch(self, num_samples, dt):
+        with self.lock:
+            self.batches += 1
+            self.samples += num_samples
+            self.busy_time += dt
+
+    def record_request(self, req, t_start):
+        with self.lock:
+            self.requests += 1
+            self.latencies.append(time.time() - req.t_arrival)
+            self.queue_waits.append(t_start - req.t_arrival)
+
+    def summary(self):
+        def percentile(values, q):
+            values = sorted(values)
+            return values[min(len(values) - 1, int(q * len(values)))] * 1000 if values else None
+        with self.lock:
+            uptime = time.time() - self.t_start
+            return {
+                'uptime_s': uptime,
+                'requests': self.requests,
+                'samples': self.samples,
+                'batches': self.batches,
+                'mean_batch_size': self.samples / self.batches if self.batches else None,
+                'samples_per_s': self.samples / uptime,
+                'samples_per_busy_s': self.samples / self.busy_time if self.busy_time else None,
+                'utilization': self.busy_time / uptime,
+                'latency_ms_p50': percentile(self.latencies, 0.5),
+                'latency_ms_p99': percentile(self.latencies, 0.99),
+                'queue_wait_ms_p50': percentile(self.queue_waits, 0.5),
+            }
+
+class Batcher:
+    """
+    collects the incoming requests and samples them in a single background thread.
+    each round waits for the first request, keeps collecting for up to max_wait seconds
+    (or until max_batch_size samples are pending), then samples all of them with one
+    generate call, with per-row prefixes and sampling parameters.
+    """
+
+    def __init__(self, model, dataset, device='cpu', dtype='fp32', max_batch_size=256, max_wait=0.01):
+        self.model = model
+        self.dataset = dataset
+        self.device = device
+        self.dtype = dtype
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.stats = Stats()
+        self.pending = []
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, req):
+        """ queues the request and blocks until its samples are ready """
+        with self.cond:
+            self.pending.append(req)
+            self.cond.notify()
+        req.done.wait()
+        if req.error is not None:
+            raise req.error
+        return req.samples
+
+    def take(self):
+        """ blocks for the next round of requests """
+        with self.cond:
+            while not self.pending:
+                self.cond.wait()
+            deadline = self.pending[0].t_arrival + self.max_wait
+            while sum(r.num for r in self.pending) < self.max_batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            reqs, self.pending = self.pending, []
+        return reqs
+
+    def loop(self):
+        while True:
+            reqs = self.take()
+            t_start = time.time()
+            try:
+                self.run(reqs)
+            except Exception as e: # report the failure to the clients, keep serving
+                for req in reqs:
+                    req.error = e
+            for req in reqs:
+                self.stats.record_request(req, t_start)
+                req.done.set()
+
+    def run(self, reqs):
+        """ samples all the requests with one generate call """
+        t0 = time.time()
+        vocab_size = self.dataset.get_vocab_size()
+        nums = torch.tensor([r.num for r in reqs])
+        def per_row(values, dtype):
+            return torch.tensor(values, dtype=dtype).repeat_interleave(nums).to(self.device)
+        # every row starts with the <START> token (index 0) followed by its prefix, padded to the longest
+        lengths = per_row([len(r.prefix) + 1 for r in reqs], torch.long)
+        X_init = torch.zeros(len(reqs), max(len(r.prefix) for r in reqs) + 1, dtype=torch.long)
+        for i, r in enumerate(reqs):
+            X_init[i, 1:len(r.prefix)+1] = r.prefix
+        X_init = X_init.repeat_interleave(nums, dim=0).to(self.device)
+        # the filters only run if some request asked for them, they are no-ops for the others
+        temperature = per_row([r.temperature for r in reqs], torch.float)
+        top_k = per_row([r.top_k or vocab_size for r in reqs], torch.long) if any(r.top_k for r in reqs) else None
+        top_p = per_row([r.top_p or 1.0 for r in reqs], torch.float) if any(r.top_p for r in reqs) else None
+        disallowed = None
+        if any(len(r.disallowed) for r in reqs):
+            disallowed = torch.zeros(len(reqs), vocab_size, dtype=torch.bool)
+            for i, r in enumerate(reqs):
+                disallowed[i, r.disallowed] = True
+            disallowed = disallowed.repeat_interleave(nums, dim=0).to(self.device)
+        steps = self.dataset.get_output_length() - int(lengths.min())
+        with autocast(self.device, self.dtype):
+            X_samp = generate_until_stop(self.model, X_init, steps, temperature=temperature, top_k=top_k, top_p=top_p,
+                                         disallowed=disallowed, lengths=lengths, do_sample=True)
+        # crop out the <START> token and hand each request its own rows
+        words = [self.dataset.decode(seq[1:].tolist()) for seq in X_samp]
+        for r in reqs:
+            r.samples, words = words[:r.num], words[r.num:]
+        self.stats.record_batch(X_init.size(0), time.time() - t0)
+
+# -----------------------------------------------------------------------------
+
+class SampleServer(ThreadingHTTPServer):
+    """ one thread per connection, they all just wait on the batcher """
+    daemon_threads = True
+    request_queue_size = 1024 # the default backlog of 5 resets bursts of concurrent clients
+
+    def __init__(self, address, batcher, max_samples):
+        super().__init__(address, SampleHandler)
+        self.batcher = batcher
+        self.max_samples = max_samples
+
+class SampleHandler(BaseHTTPRequestHandler):
+    """ POST /sample with a json body {num, temperature, top_k, top_p, prefix, disallow}, GET /stats """
+
+    def reply(self, code, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/stats':
+            return self.reply(404, {'error': f"unknown path {self.path}"})
+        self.reply(200, self.server.batcher.stats.summary())
+
+    def do_POST(self):
+        if self.path != '/sample':
+            return self.reply(404, {'error': f"unknown path {self.path}"})
+        try:
+            req = self.parse_request_body()
+        except (ValueError, KeyError, TypeError) as e:
+            return self.reply(400, {'error': str(e)})
+        try:
+            samples = self.server.batcher.submit(req)
+        except Exception as e:
+            return self.reply(500, {'error': str(e)})
+        self.reply(200, {'samples': samples})
+
+    def parse_request_body(self):
+        """ validates the json body of a sample request into a SampleRequest """
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length) or b'{}')
+        dataset = self.server.batcher.dataset
+        num = int(body.get('num', 1))
+        temperature = float(body.get('temperature', 1.0))
+        top_k = body.get('top_k')
+        top_k = None if top_k is None or int(top_k) == -1 else min(int(top_k), dataset.get_vocab_size())
+        top_p = body.get('top_p')
+        top_p = None if top_p is None or float(top_p) >= 1 else float(top_p)
+        prefix = str(body.get('prefix', ''))
+        disallow = str(body.get('disallow', ''))
+        if not 1 <= num <= self.server.max_samples:
+            raise ValueError(f"num must be between 1 and {self.server.max_samples}")
+        if temperature <= 0:
+            raise ValueError("temperature must be positive")
+        if top_k is not None and top_k < 1:
+            raise ValueError("top_k must be positive, or -1 for no top-k")
+        if top_p is not None and top_p <= 0:
+            raise ValueError("top_p must be positive, or 1.0 for no top-p")
+        if len(prefix) > dataset.max_word_length:
+            raise ValueError(f"prefix is longer than the longest word ({dataset.max_word_length})")
+        unknown = sorted(set(prefix + disallow) - set(dataset.stoi))
+        if unknown:
+            raise ValueError(f"characters that are not in the vocabulary: {''.join(unknown)!r}")
+        # note: the <STOP> token is never disallowed, so every row can always finish
+        return SampleRequest(num, temperature, top_k, top_p, dataset.encode(prefix), dataset.encode(disallow))
+
+    def log_message(self, format, *args):
+        pass # the per-request access log would dominate the output, see /stats instead
+
+# -----------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Make More sampling server")
+    # model, the same flags as makemore.py. the model's sidecar (meta.json) in the work dir has its type,
+    # config and vocabulary, so the input file and model flags are only used for a work dir without one
+    parser.add_argument('--input-file', '-i', type=str, default='names.txt', help="input file the model was trained on")
+    parser.add_argument('--work-dir', '-o', type=str, default='out', help="output working directory with the model.pt")
+    parser.add_argument('--device', type=str, default='cpu', help="device to use for compute, examples: cpu|cuda|cuda:2|mps")
+    parser.add_argument('--dtype', type=str, default='fp32', choices=['fp32', 'bf16'], help="precision of the forward passes, bf16 runs them under autocast")
+    parser.add_argument('--type', type=str, default='transformer', help="model class type to use, bigram|mlp|rnn|gru|bow|transformer")
+    parser.add_argument('--n-layer', type=int, default=4, help="number of layers")
+    parser.add_argument('--n-head', type=int, default=4, help="number of heads (in a transformer)")
+    parser.add_argument('--n-embd', type=int, default=64, help="number of feature channels in the model")
+    parser.add_argument('--n-embd2', type=int, default=64, help="number of feature channels elsewhere in the model")
+    # serving
+    parser.add_argument('--host', type=str, default='127.0.0.1', help="address to listen on")
+    parser.add_argument('--port', type=int, default=8000, help="port to listen on")
+    parser.add_argument('--max-batch-size', type=int, default=256, help="stop collecting requests for a batch once this many samples are pending")
+    parser.add_argument('--max-wait-ms', type=float, default=10.0, help="how long the first request of a batch waits for others to join it")
+    parser.add_argument('--max-samples', type=int, default=1000, help="maximum number of samples of a single request")
+    parser.add_argument('--seed', type=int, default=3407, help="seed")
+    args = parser.parse_args()
+    print(vars(args))
+
+    torch.manual_seed(args.seed)
+    meta = load_meta(args.work_dir)
+    if meta is not None:
+        args.type = meta['type']
+        config = ModelConfig(**meta['config'])
+        train_dataset, _ = datasets_from_meta(meta) # only the vocabulary is needed, not the words
+    else:
+        train_dataset, _ = create_datasets(args.input_file)
+        config = ModelConfig(vocab_size=train_dataset.get_vocab_size(), block_size=train_dataset.get_output_length(),
+                             n_layer=args.n_layer, n_head=args.n_head, n_embd=args.n_embd, n_embd2=args.n_embd2)
+    model = create_model(args.type, config)
+    model.load_state_dict(torch.load(os.path.join(args.work_dir, 'model.pt'), map_location=args.device))
+    model.to(args.device)
+    model.eval()
+
+    batcher = Batcher(model, train_dataset, device=args.device, dtype=args.dtype,
+                      max_batch_size=args.max_batch_size, max_wait=args.max_wait_ms / 1000)
+    server = SampleServer((args.host, args.port), batcher, args.max_samples)
+    print(f"serving on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -1,22 +1,123 @@
 import numpy as np
 
 N_sample=100000 # 采样数量, 理论上越大, 积分数值越准
-M=4.02 # M应该略大于 f(x)在积分区间上最大值, 因此调整函数和区间后, 需要调整 M
+CHUNK_SIZE=1000000 # 每块的采样数量, 每次只在内存中保存一块, 因此 N_sample 可以取到 10^9 甚至更大
+N_probe=10000 # 自动估计 f(x) 上下界时的探测点数量
 # np.random.seed(42)  # 固定种子为42（任意整数均可）, 从而使得每次运行生成相同的 x1 和 x2
+
+
+def vectorized(f, start, end):
+    # 引擎对整个数组调用 f, 若 f 只接受标量 (例如用了 math.sin), 退回到 np.vectorize, 结果一样但会慢很多
+    x = np.linspace(start, end, 3)
+    try:
+        y = np.asarray(f(x), dtype=float)
+        if y.shape == x.shape:
+            return f
+    except (TypeError, ValueError):
+        pass
+    print("f 不支持数组输入, 改用 np.vectorize 逐点计算, 速度会慢很多")
+    return np.vectorize(f, otypes=[float])
+
+
+def estimate_bounds(f, start, end, rng, margin=0.05):
+    '''
+        在均匀网格和随机点上计算 f, 估计 f(x) 在积分区间上的下界 m 和上界 M.
+        Return Values:
+            m, M: 各向外放宽了 margin*(M-m), 并且 m<=0<=M, 即 f 非负时 m=0, 与原来的 hit-or-miss 一致
+    '''
+    x = np.concatenate([np.linspace(start, end, N_probe), rng.uniform(start, end, N_probe)])
+    y = f(x)
+    f_min, f_max = min(float(y.min()), 0.0), max(float(y.max()), 0.0)
+    pad = margin * (f_max - f_min)
+    m = f_min - pad if f_min < 0 else 0.0
+    M = f_max + pad if f_max > 0 else 0.0
+    if M == m: # f 在区间上恒为 0
+        M = 1.0
+    return m, M
+
+
+def MonteCarlo_Integrate(f, start, end, n_sample=None, method='mean', M=None, m=None,
+                         chunk_size=CHUNK_SIZE, tol=None, seed=None):
+    '''
+        分块向量化的蒙特卡洛积分, 每块采样 chunk_size 个点, 对整块数组计算 f, 内存占用与 n_sample 无关.
+        Parameters:
+            f(x): 被积函数, 最好能直接作用于 numpy 数组 (否则自动逐点计算)
+            start, end: 积分区间
+            n_sample: 采样数量, 默认为全局 N_sample
+            method: 'mean' 为平均值法, 积分 = (end-start)*mean(f(x));
+                    'hit_or_miss' 为投点法, 在 [start, end]x[m, M] 的矩形中均匀投点, 统计落在 f(x) 下方的比例
+            M, m: 投点法中 f(x) 的上下界, 为 None 时自动估计 (f 非负时 m=0)
+            chunk_size: 每块的采样数量
+            tol: 若给定, 标准误差小于 tol 时提前结束 (至少算完一块)
+            seed: 随机数种子, 固定后每次运行结果相同
+
+        Return Values:
+            S_integral: 积分的估计值
+            std_err: 估计值的标准误差, 误差以 1/sqrt(n) 的速度减小
+    '''
+    n_sample = N_sample if n_sample is None else n_sample
+    rng = np.random.default_rng(seed)
+    f = vectorized(f, start, end)
+    width = end - start
+
+    if method == 'hit_or_miss':
+        if M is None or m is None:
+            m_est, M_est = estimate_bounds(f, start, end, rng)
+            m = m_est if m is None else m
+            M = M_est if M is None else M
+        S = width * (M - m) # 投点矩形的面积
+    elif method != 'mean':
+        raise ValueError(f"未知的 method: {method}, 应为 'mean' 或 'hit_or_miss'")
+
+    n = 0 # 已采样的点数
+    hits = 0 # 投点法: 落在 f(x) 下方的点数
+    mean, m2 = 0.0, 0.0 # 平均值法: f(x) 的均值和离差平方和, 逐块合并 (Chan 的并行算法), 避免大 n 时的精度损失
+    f_lo, f_hi = np.inf, -np.inf # 实际见到的 f(x) 范围, 用于检查 m, M 是否真的是上下界
+    while n < n_sample:
+        k = min(chunk_size, n_sample - n)
+        xs = rng.uniform(low=start, high=end, size=k)
+        fx = f(xs)
+        f_lo, f_hi = min(f_lo, float(fx.min())), max(f_hi, float(fx.max()))
+        if method == 'hit_or_miss':
+            ys = rng.uniform(low=m, high=M, size=k)
+            hits += int(np.count_nonzero(ys < fx))
+        else:
+            chunk_mean = float(fx.mean())
+            chunk_m2 = float(((fx - chunk_mean)**2).sum())
+            delta = chunk_mean - mean
+            mean += delta * k / (n + k)
+            m2 += chunk_m2 + delta**2 * n * k / (n + k)
+        n += k
+
+        if method == 'hit_or_miss':
+            p = hits / n
+            # y 在 [m, M] 上均匀分布, P(y<f(x)) = (f(x)-m)/(M-m), 所以积分 = (end-start)*m + S*p
+            S_integral = width * m + S * p
+            std_err = S * float(np.sqrt(p * (1 - p) / n))
+        else:
+            S_integral = width * mean
+            std_err = abs(width) * float(np.sqrt(m2 / max(n - 1, 1) / n))
+        if tol is not None and std_err < tol:
+            break
+
+    if method == 'hit_or_miss' and (f_hi > M or f_lo < m):
+        print(f"警告: f(x) 的取值范围 [{f_lo:.4g}, {f_hi:.4g}] 超出了 [m, M]=[{m:.4g}, {M:.4g}], 投点法的结果有偏差, 请调大 M (或调小 m)")
+    return S_integral, std_err
+
+
 def MonteCarlo_Integral(f, start, end):
-    # global N_sample
-   
-    xs = np.random.uniform(low=start, high=end, size=N_sample)
-    ys = np.random.uniform(low=0, high=M, size=N_sample)
-    S=(end-start)*M
-    cnt=0
-    for x, y in zip(xs, ys):
-        if y<f(x):
-            cnt+=1
-    S_integral=S*cnt/N_sample
+    # 原来的接口: 投点法, 采样 N_sample 个点, 只返回积分值, M 改为自动估计
+    S_integral, _ = MonteCarlo_Integrate(f, start, end, method='hit_or_miss')
     return S_integral
 
 
 if __name__=='__main__':
+    import time
+
     print(MonteCarlo_Integral(lambda x:x**2, 0, 2))
 
+    # 两种方法的对比, 精确值为 8/3
+    for method in ['hit_or_miss', 'mean']:
+        t0 = time.time()
+        S_integral, std_err = MonteCarlo_Integrate(lambda x:x**2, 0, 2, n_sample=10**8, method=method, seed=42)
+        print(f"{method}: {S_integral:.6f} ± {std_err:.6f} (精确值 {8/3:.6f}), 用时 {time.time()-t0:.2f}s")